@@ -0,0 +1,198 @@
+# device registry: magnet/BPM groups, control systems & name aliases
+
+import os
+import re
+import json
+import hashlib
+
+"""
+groups are read from a local directory file (devices.json) and optionally extended from
+the BMAD lattice, lattice-derived registries are cached in a versioned json index keyed
+by the hash of the directory file & lattice sources so startup doesn't re-parse the lattice
+"""
+
+REGISTRY_VERSION = 1
+DEVICE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'devices.json')
+INDEX_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'f2-pytools', 'device_index.json')
+LATTICE_ROOT = '/usr/local/facet/tools/facet2-lattice/bmad'
+TAO_INIT_FILE = os.path.join(LATTICE_ROOT, 'models', 'f2_elec', 'tao.init')
+
+# SLC-controlled sectors, i.e. LI14 in XCOR:LI14:402
+SLC_SECTOR_RE = re.compile(r'^LI1\d$')
+
+# BMAD element keys for each generated group
+BMAD_GROUPS = {
+    'SLC_QUADS': ('Quadrupole',),
+    'SLC_CORRECTORS': ('HKicker', 'VKicker'),
+    'AIDA_NAME_FLIP_LIST': ('Monitor',),
+    }
+
+# SLC database attribute read to check that a lattice device is controlled through SCP,
+# EPICS devices in the same sectors (i.e. XCOR:LI11:304) have no SLC database entry
+SLC_PROBE_ATTR = {
+    'SLC_QUADS': 'BDES',
+    'SLC_CORRECTORS': 'BDES',
+    'AIDA_NAME_FLIP_LIST': 'Z',
+    }
+
+def _flip(name):
+    """ switch things like LI14:QUAD:401 --> QUAD:LI14:401 and vice versa """
+    ds = name.split(':')
+    return f'{ds[1]}:{ds[0]}:{ds[2]}'
+
+class DeviceRegistry:
+    """
+    hashed lookups of device groups, control systems & aliases
+
+    Examples:
+      REGISTRY.in_group('BPMS:LI19:501', 'LI19_BLACKLIST')
+      REGISTRY.control_system('LI14:XCOR:402')  # 'SLC'
+      REGISTRY.canonical('LI14:XCOR:402')       # 'XCOR:LI14:402'
+    """
+
+    def __init__(self, groups, systems, model_names=None):
+        # ordered, deduplicated group members
+        self.groups = {g: list(dict.fromkeys(devs)) for g, devs in groups.items()}
+        self.systems = {s: list(gs) for s, gs in systems.items()}
+        self._members = {g: frozenset(devs) for g, devs in self.groups.items()}
+
+        self._control = {}
+        self._canonical = {}
+        for system, system_groups in self.systems.items():
+            for g in system_groups:
+                for dev in self.groups.get(g, []):
+                    self._control[dev] = system
+                    self._canonical[dev] = dev
+                    self._canonical[_flip(dev)] = dev
+
+        # model (BMAD/AIDA) names for BPMs in flipped name format, with explicit exceptions
+        self._model_names = {dev: _flip(dev) for dev in self.groups.get('AIDA_NAME_FLIP_LIST', [])}
+        self._model_names.update(model_names or {})
+
+    def __contains__(self, device): return device in self._canonical
+
+    def names(self, group):
+        """ ordered list of devices in 'group' """
+        return list(self.groups[group])
+
+    def in_group(self, device, group):
+        return device in self._members.get(group, ())
+
+    def control_system(self, device, default='EPICS'):
+        """ control system for a device in either name format """
+        return self._control.get(self._canonical.get(device, device), default)
+
+    def canonical(self, device):
+        """ canonical (EPICS-style) name for a registered device in either name format """
+        return self._canonical.get(device, device)
+
+    def model_name(self, device):
+        """ name of a device in the model, i.e. BPMS:LI11:401 --> LI11:BPMS:401 """
+        return self._model_names.get(device, device)
+
+    def to_dict(self):
+        return {'groups': self.groups, 'systems': self.systems, 'model_names': self._model_names}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['groups'], d['systems'], d.get('model_names'))
+
+def _read_device_file(path):
+    with open(path, 'r') as f: return json.load(f)
+
+def _bmad_groups(model):
+    """
+    generate groups from the whole lattice of a orbit_fitting.BMADMODEL.bmadModel, only elements
+    in the SLC sectors (LI11-LI19) that have an SLC database entry are included, LI20 devices come
+    from the directory file
+
+    only a device whose probe failed with a non-retryable error (no SLC database entry) is excluded
+    for good, returns (groups, complete) where 'complete' is False if any probe timed out or hit an
+    open circuit, those devices are left out of this registry & the result shouldn't be cached
+    """
+    from slc_mags import get_aidapva_many, NO_RETRY, CircuitOpenError
+    key_group = {key: g for g, keys in BMAD_GROUPS.items() for key in keys}
+    names = model.tao.lat_list('*', 'ele.name')
+    keys = model.tao.lat_list('*', 'ele.key')
+    candidates = {g: [] for g in BMAD_GROUPS}
+    for ele, key in zip(names, keys):
+        g = key_group.get(key)
+        if g is None: continue
+        alias = model.tao.ele_head(ele)['alias']
+        if alias.count(':') == 2 and SLC_SECTOR_RE.match(alias.split(':')[1]):
+            candidates[g].append(alias)
+
+    groups, unresolved = {}, []
+    for g, devs in candidates.items():
+        devs = list(dict.fromkeys(devs))
+        probes = [f'{d}:{SLC_PROBE_ATTR[g]}' for d in devs]
+        values, errors = get_aidapva_many(probes, tryagain=False)
+        groups[g] = [d for d, v in zip(devs, values) if v is not None]
+        unresolved += [d for d, pv in zip(devs, probes)
+            if isinstance(errors.get(pv), NO_RETRY.retry_on + (CircuitOpenError,))]
+    if unresolved:
+        print(f'could not check {len(unresolved)} lattice devices, the device index is not saved: {unresolved}')
+    return groups, not unresolved
+
+def _lattice_files(root=LATTICE_ROOT):
+    """ every file of the lattice (tao.init & the lattice files it pulls in), in a stable order """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        files += [os.path.join(dirpath, f) for f in sorted(filenames) if not f.startswith('.')]
+    return files
+
+def _source_hash(paths):
+    """ hash of the path, size & mtime of each source file, a stat per file so startup doesn't read the lattice """
+    h = hashlib.sha1(str(REGISTRY_VERSION).encode())
+    for path in paths:
+        st = os.stat(path)
+        h.update(f'{path}:{st.st_size}:{st.st_mtime_ns}'.encode())
+    return h.hexdigest()
+
+def _load_index(index_path, source_hash):
+    """ returns the cached registry dict if the index matches the version & source hash """
+    try:
+        with open(index_path, 'r') as f: index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != REGISTRY_VERSION or index.get('source_hash') != source_hash: return None
+    return index['registry']
+
+def _save_index(index_path, source_hash, registry):
+    """ best-effort write of the index, a read-only cache location is not an error """
+    try:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        tmp = f'{index_path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': REGISTRY_VERSION, 'source_hash': source_hash, 'registry': registry.to_dict()}, f)
+        os.replace(tmp, index_path)
+    except OSError as e:
+        print(f'could not write device index {index_path}: {e}')
+
+def load_registry(path=DEVICE_FILE, use_bmad=False, index_path=INDEX_PATH):
+    """
+    load the device registry from the directory file 'path', if 'use_bmad' is set the
+    SLC quad/corrector/BPM groups are extended with the SLC devices found in the BMAD lattice
+
+    lattice-derived registries are cached at 'index_path' (None to disable) and reused as long as
+    no directory or lattice file has changed size or mtime, the directory file alone is just read
+    """
+    d = _read_device_file(path)
+    if not use_bmad: return DeviceRegistry(d['groups'], d['systems'], d.get('model_names'))
+
+    source_hash = _source_hash([path] + _lattice_files())
+    if index_path is not None:
+        cached = _load_index(index_path, source_hash)
+        if cached is not None: return DeviceRegistry.from_dict(cached)
+
+    from orbit_fitting.BMADMODEL import bmadModel
+    groups = d['groups']
+    bmad_groups, complete = _bmad_groups(bmadModel())
+    for g, devs in bmad_groups.items():
+        groups[g] = groups.get(g, []) + devs
+    registry = DeviceRegistry(groups, d['systems'], d.get('model_names'))
+    if index_path is not None and complete: _save_index(index_path, source_hash, registry)
+    return registry
+
+REGISTRY = load_registry()
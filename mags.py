@@ -2,329 +2,242 @@
 
 import os
 import sys
-from epics import get_pv
+import threading
+from functools import lru_cache
+import numpy as np
+from time import monotonic, time
+from concurrent.futures import ThreadPoolExecutor, Future
+from epics import get_pv, caget_many
 import slc_mags
+from device_registry import REGISTRY
 from traceback import print_exc
 
-SLC_QUADS = [
-    'QUAD:LI11:401',
-    'QUAD:LI11:501',
-    'QUAD:LI11:601',
-    'QUAD:LI11:701',
-    'QUAD:LI11:801',
-    'QUAD:LI11:901',
-    'QUAD:LI12:201',
-    'QUAD:LI12:301',
-    'QUAD:LI12:401',
-    'QUAD:LI12:501',
-    'QUAD:LI12:601',
-    'QUAD:LI12:701',
-    'QUAD:LI12:801',
-    'QUAD:LI12:901',
-    'QUAD:LI13:201',
-    'QUAD:LI13:301',
-    'QUAD:LI13:401',
-    'QUAD:LI13:501',
-    'QUAD:LI13:601',
-    'QUAD:LI13:701',
-    'QUAD:LI13:801',
-    'QUAD:LI13:901',
-    'QUAD:LI14:201',
-    'QUAD:LI14:301',
-    'QUAD:LI14:401',
-    'QUAD:LI14:501',
-    'QUAD:LI14:601',
-    'QUAD:LI15:201',
-    'QUAD:LI15:301',
-    'QUAD:LI15:401',
-    'QUAD:LI15:501',
-    'QUAD:LI15:601',
-    'QUAD:LI15:701',
-    'QUAD:LI15:801',
-    'QUAD:LI15:901',
-    'QUAD:LI16:201',
-    'QUAD:LI16:301',
-    'QUAD:LI16:401',
-    'QUAD:LI16:501',
-    'QUAD:LI16:601',
-    'QUAD:LI16:701',
-    'QUAD:LI16:801',
-    'QUAD:LI16:901',
-    'QUAD:LI17:201',
-    'QUAD:LI17:301',
-    'QUAD:LI17:401',
-    'QUAD:LI17:501',
-    'QUAD:LI17:601',
-    'QUAD:LI17:701',
-    'QUAD:LI17:801',
-    'QUAD:LI17:901',
-    'QUAD:LI18:201',
-    'QUAD:LI18:301',
-    'QUAD:LI18:401',
-    'QUAD:LI18:501',
-    'QUAD:LI18:601',
-    'QUAD:LI18:701',
-    'QUAD:LI18:801',
-    'QUAD:LI18:901',
-    'QUAD:LI19:201',
-    'QUAD:LI19:301',
-    'QUAD:LI19:401',
-    'QUAD:LI19:501',
-    'QUAD:LI19:601',
-    'QUAD:LI19:701',
-    'QUAD:LI19:801',
-    'QUAD:LI20:2086',
-    'LGPS:LI20:2130',
-    'LGPS:LI20:2150',
-    'LGPS:LI20:2150',
-    'LGPS:LI20:2200',
-    'LGPS:LI20:2200',
-    'LGPS:LI20:2200',
-    'LGPS:LI20:2230',
-    'LGPS:LI20:2251',
-    'LGPS:LI20:2230',
-    'LGPS:LI20:2200',
-    'LGPS:LI20:2200',
-    'LGPS:LI20:2200',
-    'LGPS:LI20:2150',
-    'LGPS:LI20:2150',
-    'LGPS:LI20:2130',
-    'LGPS:LI20:2060',
-    'LGPS:LI20:3011',
-    'LGPS:LI20:3311',
-    'LGPS:LI20:3151',
-    'LGPS:LI20:3091',
-    'LGPS:LI20:3141',
-    'LGPS:LI20:3151',
-    'LGPS:LI20:3204',
-    'LGPS:LI20:3261',
-    'LGPS:LI20:3311',
-    ]
-
-SLC_CORRECTORS = [
-    'XCOR:LI11:402',
-    'YCOR:LI11:403',
-    'XCOR:LI11:502',
-    'YCOR:LI11:503',
-    'XCOR:LI11:602',
-    'YCOR:LI11:603',
-    'XCOR:LI11:702',
-    'YCOR:LI11:703',
-    'XCOR:LI11:802',
-    'YCOR:LI11:803',
-    'XCOR:LI11:900',
-    'YCOR:LI11:900',
-    'XCOR:LI12:202',
-    'YCOR:LI12:203',
-    'XCOR:LI12:302',
-    'YCOR:LI12:303',
-    'XCOR:LI12:402',
-    'YCOR:LI12:403',
-    'XCOR:LI12:502',
-    'YCOR:LI12:503',
-    'XCOR:LI12:602',
-    'YCOR:LI12:603',
-    'XCOR:LI12:702',
-    'YCOR:LI12:703',
-    'XCOR:LI12:802',
-    'YCOR:LI12:803',
-    'XCOR:LI12:900',
-    'YCOR:LI12:900',
-    'XCOR:LI13:202',
-    'YCOR:LI13:203',
-    'XCOR:LI13:302',
-    'YCOR:LI13:303',
-    'XCOR:LI13:402',
-    'YCOR:LI13:403',
-    'XCOR:LI13:502',
-    'YCOR:LI13:503',
-    'XCOR:LI13:602',
-    'YCOR:LI13:603',
-    'XCOR:LI13:702',
-    'YCOR:LI13:703',
-    'XCOR:LI13:802',
-    'YCOR:LI13:803',
-    'XCOR:LI13:900',
-    'YCOR:LI13:900',
-    'XCOR:LI14:202',
-    'YCOR:LI14:203',
-    'XCOR:LI14:302',
-    'YCOR:LI14:303',
-    'XCOR:LI14:402',
-    'YCOR:LI14:403',
-    'XCOR:LI14:502',
-    'YCOR:LI14:503',
-    'XCOR:LI14:602',
-    'YCOR:LI14:603',
-    'XCOR:LI14:702',
-    'YCOR:LI14:703',
-    'XCOR:LI14:900',
-    'YCOR:LI14:900',
-    'XCOR:LI15:202',
-    'YCOR:LI15:203',
-    'XCOR:LI15:302',
-    'YCOR:LI15:303',
-    'XCOR:LI15:402',
-    'YCOR:LI15:403',
-    'XCOR:LI15:502',
-    'YCOR:LI15:503',
-    'XCOR:LI15:602',
-    'YCOR:LI15:603',
-    'XCOR:LI15:702',
-    'YCOR:LI15:703',
-    'XCOR:LI15:802',
-    'YCOR:LI15:803',
-    'XCOR:LI15:900',
-    'YCOR:LI15:900',
-    'XCOR:LI16:202',
-    'YCOR:LI16:203',
-    'XCOR:LI16:302',
-    'YCOR:LI16:303',
-    'XCOR:LI16:402',
-    'YCOR:LI16:403',
-    'XCOR:LI16:502',
-    'YCOR:LI16:503',
-    'XCOR:LI16:602',
-    'YCOR:LI16:603',
-    'XCOR:LI16:702',
-    'YCOR:LI16:703',
-    'XCOR:LI16:802',
-    'YCOR:LI16:803',
-    'XCOR:LI16:900',
-    'YCOR:LI16:900',
-    'XCOR:LI17:202',
-    'YCOR:LI17:203',
-    'XCOR:LI17:302',
-    'YCOR:LI17:303',
-    'XCOR:LI17:402',
-    'YCOR:LI17:403',
-    'XCOR:LI17:502',
-    'YCOR:LI17:503',
-    'XCOR:LI17:602',
-    'YCOR:LI17:603',
-    'XCOR:LI17:702',
-    'YCOR:LI17:703',
-    'XCOR:LI17:802',
-    'YCOR:LI17:803',
-    'XCOR:LI17:900',
-    'YCOR:LI17:900',
-    'XCOR:LI18:202',
-    'YCOR:LI18:203',
-    'XCOR:LI18:302',
-    'YCOR:LI18:303',
-    'XCOR:LI18:402',
-    'YCOR:LI18:403',
-    'XCOR:LI18:502',
-    'YCOR:LI18:503',
-    'XCOR:LI18:602',
-    'YCOR:LI18:603',
-    'XCOR:LI18:702',
-    'YCOR:LI18:703',
-    'XCOR:LI18:802',
-    'YCOR:LI18:803',
-    'XCOR:LI18:900',
-    'YCOR:LI18:900',
-    'XCOR:LI19:202',
-    'YCOR:LI19:203',
-    'XCOR:LI19:302',
-    'YCOR:LI19:303',
-    'XCOR:LI19:402',
-    'YCOR:LI19:403',
-    'XCOR:LI19:502',
-    'YCOR:LI19:503',
-    'XCOR:LI19:602',
-    'YCOR:LI19:603',
-    'YCOR:LI19:700',
-    'XCOR:LI19:700',
-    'XCOR:LI19:802',
-    'YCOR:LI19:803',
-    'XCOR:LI19:900',
-    'YCOR:LI19:900',
-    'XCOR:LI20:1996',
-    'YCOR:LI20:2087',
-    'XCOR:LI20:2096',
-    'XCOR:LI20:2176',
-    'YCOR:LI20:2181',
-    'YCOR:LI20:2230',
-    'YCOR:LI20:2267',
-    'YCOR:LI20:2321',
-    'XCOR:LI20:2326',
-    'XCOR:LI20:2396',
-    'BTRM:LI20:2420',
-    'XCOR:LI20:2460',
-    'XCOR:LI20:3026',
-    'YCOR:LI20:3017',
-    'YCOR:LI20:3057',
-    'XCOR:LI20:3086',
-    'XCOR:LI20:3276',
-    'XCOR:LI20:3116',
-    'YCOR:LI20:3147',
-    ]
-
-SLC_BENDS = [
-    'LGPS:LI20:1990',
-    'LGPS:LI20:2110',
-    'LGPS:LI20:2240',
-    'LGPS:LI20:2240',
-    'LGPS:LI20:2110',
-    'LGPS:LI20:2420',
-    'BTRM:LI20:2420',
-    'LGPS:LI20:2420',
-    'LGPS:LI20:1990',
-    'BEND:LI20:3330',
-    ]
+# SLC magnet groups, see devices.json
+SLC_QUADS = REGISTRY.names('SLC_QUADS')
+SLC_CORRECTORS = REGISTRY.names('SLC_CORRECTORS')
+SLC_BENDS = REGISTRY.names('SLC_BENDS')
 
 ALL_SLC_MAGNETS = SLC_CORRECTORS + SLC_QUADS + SLC_BENDS
 
 def _is_legacy_dev_name(device):
     return (device[:2] == 'LI')
 
-def _is_SLC_device(device):
-    """ returns true if the magnet is controlled via SCP """
-    return _is_legacy_dev_name(device) or (device in ALL_SLC_MAGNETS)
-
+@lru_cache(maxsize=None)
 def _switch_primary_micro(device):
     """ switch things like LI14:QUAD --> QUAD:LI14 and vice versa """
     ds = device.split(':')
     return f'{ds[1]}:{ds[0]}:{ds[2]}'
 
-def set_magnets(devices, values, timeout=12):
-    """
-    set an arbitrary number of magnet BDESes, 'devices' may contain either
-    SLC or EPICS magnets.
+def _is_SLC_device(device):
+    """ returns true if the magnet is controlled via SCP """
+    return _is_legacy_dev_name(device) or (REGISTRY.control_system(device) == 'SLC')
 
-    NOTE: EPICS magnets and SLC magnets will be set in steps as separate groups
-    so the order of magnet trims may not match the order of 'devices'/'values'
-    """
-    if len(devices) != len(values): raise ValueError('device/value list mismatch')
+def _canonical_name(device):
+    """ returns the canonical (EPICS-style) name for a device in either name format """
+    if device in REGISTRY: return REGISTRY.canonical(device)
+    return _switch_primary_micro(device) if _is_legacy_dev_name(device) else device
 
-    # split device/value list into EPICS & SLC parts
+def _split_devices(devices, values):
+    """ split device/value lists into (SLC devices, SLC values), (EPICS devices, EPICS values) """
     slc_devices, slc_values = [], []
     epics_devices, epics_values = [], []
     for dev,val in zip(devices, values):
         if _is_SLC_device(dev):
-            if _is_legacy_dev_name(dev):
-                dev = _switch_primary_micro(dev)
-            slc_devices.append(dev)
+            slc_devices.append(_canonical_name(dev))
             slc_values.append(val)
         else:
             epics_devices.append(dev)
             epics_values.append(val)
-    
-    # set EPICS magnets
-    print('Setting EPICS magnets ...')
-    for dev,val in zip(epics_devices, epics_values):
+    return (slc_devices, slc_values), (epics_devices, epics_values)
+
+def get_magnets(devices, attr='BDES', timeout=2.0):
+    """
+    bulk read of an attribute (BDES, BACT ...) for SLC and/or EPICS magnets, the SLC
+    values are read with batched AIDA-PVA calls while the EPICS values are read with caget_many
+    returns a list of values in the same order as 'devices', None for values that could not be read
+    """
+    (slc_devices, _), (epics_devices, _) = _split_devices(devices, [None]*len(devices))
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        slc_read = pool.submit(slc_mags.get_aidapva_many, [f'{dev}:{attr}' for dev in slc_devices], timeout=timeout)
+        epics_vals = caget_many([f'{dev}:{attr}' for dev in epics_devices], timeout=timeout) if epics_devices else []
+        slc_vals, _ = slc_read.result()
+    slc_vals, epics_vals = iter(slc_vals), iter(epics_vals)
+    return [next(slc_vals) if _is_SLC_device(dev) else next(epics_vals) for dev in devices]
+
+def _drop_unchanged(devices, values, tol):
+    """ returns (devices, values) that differ from the current BDES by more than 'tol', and the skipped devices """
+    current = get_magnets(devices, 'BDES')
+    changed_devices, changed_values, skipped = [], [], []
+    for dev, val, cur in zip(devices, values, current):
+        if cur is not None and abs(val - cur) <= tol:
+            skipped.append(dev)
+        else:
+            changed_devices.append(dev)
+            changed_values.append(val)
+    return changed_devices, changed_values, skipped
+
+def set_magnets(devices, values, timeout=12, skip_unchanged=False, tol=1e-4):
+    """
+    set an arbitrary number of magnet BDESes, 'devices' may contain either
+    SLC or EPICS magnets.
+
+    if 'skip_unchanged' is set, the current BDES of all devices is read first
+    and devices already within 'tol' of the requested value are not trimmed,
+    the list of skipped devices is returned
+
+    NOTE: EPICS magnets and SLC magnets are set concurrently as separate groups
+    so the order of magnet trims may not match the order of 'devices'/'values'
+    """
+    if len(devices) != len(values): raise ValueError('device/value list mismatch')
+
+    skipped = []
+    if skip_unchanged:
+        devices, values, skipped = _drop_unchanged(devices, values, tol)
+        print(f'Skipping {len(skipped)} unchanged magnets: {skipped}')
+
+    # split device/value list into EPICS & SLC parts
+    (slc_devices, slc_values), (epics_devices, epics_values) = _split_devices(devices, values)
+
+    # SLC trim runs in the background while the EPICS magnets are set
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        if slc_devices:
+            print('Setting SLC magnets ...')
+            slc_trim = pool.submit(slc_mags.set_magnets, slc_devices, slc_values, timeout=timeout)
+
+        if epics_devices:
+            print('Setting EPICS magnets ...')
+            failed = _put_all([f'{dev}:BDES' for dev in epics_devices], epics_values, timeout)
+            ok_devices = [dev for dev in epics_devices if f'{dev}:BDES' not in failed]
+            failed += _put_all([f'{dev}:CTRL' for dev in ok_devices], [1]*len(ok_devices), timeout)
+            for pvname in failed: print(f'failed to set device: {pvname.rsplit(":", 1)[0]}')
+
+        if slc_devices: slc_trim.result()
+    return skipped
+
+def _put_all(pvnames, values, timeout):
+    """
+    start non-blocking puts for all pvs & wait for their completion callbacks
+    returns the list of pvs whose put failed or did not complete within 'timeout'
+    """
+    pending = set(pvnames)
+    lock = threading.Lock()
+    all_done = threading.Event()
+    failed = []
+
+    def on_complete(pvname=None, **kw):
+        with lock:
+            pending.discard(pvname)
+            if not pending: all_done.set()
+
+    if not pending: return failed
+    for pvname, val in zip(pvnames, values):
         try:
-            get_pv(f'{dev}:BDES').put(val)
-            get_pv(f'{dev}:CTRL').put(1)
-        except Exception as e:
-            print(f'failed to set device: {dev}')
-            print_exc(e)
+            get_pv(pvname).put(val, wait=False, callback=on_complete)
+        except Exception:
+            print_exc()
+            failed.append(pvname)
+            on_complete(pvname=pvname)
+    all_done.wait(timeout)
+    with lock: failed += sorted(pending)
+    return failed
+
+def _within_tol(value, target, tol, rtol):
+    return value is not None and abs(value - target) <= tol + rtol*abs(target)
+
+def track_trims(devices, targets, tol=1e-4, rtol=1e-3, timeout=30.0, poll_period=0.5):
+    """
+    watch magnets until BACT is within tolerance of the 'targets' (usually the BDES just set)
+    EPICS magnets are watched with CA monitors, SLC magnets are polled with batched AIDA-PVA reads
+
+    returns a concurrent.futures.Future that resolves to {device: settle time in seconds}
+    once every magnet has settled or 'timeout' expires (unsettled magnets have a time of None),
+    use asyncio.wrap_future(...) to await it
+
+    Example:
+      set_magnets(devices, bdes)
+      settle_times = track_trims(devices, bdes).result()
+    """
+    done = Future()
+    t0 = monotonic()
+    settle_times = {dev: None for dev in devices}
+    target = dict(zip(devices, targets))
+    pending = set(devices)
+    lock = threading.Lock()
+    all_settled = threading.Event()
+
+    def settled(dev):
+        with lock:
+            if dev not in pending: return
+            pending.discard(dev)
+            settle_times[dev] = monotonic() - t0
+            if not pending: all_settled.set()
+
+    (slc_devices, _), (epics_devices, _) = _split_devices(devices, [None]*len(devices))
+    slc_names = dict(zip(slc_devices, [dev for dev in devices if _is_SLC_device(dev)]))
 
-    # set SLC magnets
-    print('Setting SLC magnets ...')
-    slc_mags.set_magnets(slc_devices, slc_values)
-    return
+    monitors = []
+    for dev in epics_devices:
+        def on_bact(value=None, dev=dev, **kw):
+            if _within_tol(value, target[dev], tol, rtol): settled(dev)
+        pv = get_pv(f'{dev}:BACT')
+        monitors.append((pv, pv.add_callback(on_bact, run_now=True)))
+
+    def watch():
+        deadline = t0 + timeout
+        while monotonic() < deadline and not all_settled.is_set():
+            with lock: slc_pending = [d for d in slc_names if slc_names[d] in pending]
+            if slc_pending:
+                bacts, _ = slc_mags.get_aidapva_many([f'{d}:BACT' for d in slc_pending])
+                for d, bact in zip(slc_pending, bacts):
+                    if _within_tol(bact, target[slc_names[d]], tol, rtol): settled(slc_names[d])
+            all_settled.wait(min(poll_period, max(0, deadline - monotonic())))
+        for pv, index in monitors: pv.remove_callback(index)
+        with lock: done.set_result(dict(settle_times))
+
+    if not pending: all_settled.set()
+    threading.Thread(target=watch, daemon=True).start()
+    return done
+
+class MagnetSnapshot:
+    """
+    BDES/BACT snapshot of a set of magnets, stored as a name list plus float arrays
+    (unreadable values are NaN) with the time the snapshot was taken
+    """
+
+    def __init__(self, names, bdes, bact, timestamp=None):
+        self.names = list(names)
+        self.bdes = np.asarray(bdes, dtype=float)
+        self.bact = np.asarray(bact, dtype=float)
+        self.timestamp = time() if timestamp is None else timestamp
+
+    def __len__(self): return len(self.names)
+
+    def save(self, path):
+        """ write to a compressed .npz file """
+        np.savez_compressed(path, names=np.array(self.names), bdes=self.bdes, bact=self.bact,
+            timestamp=self.timestamp)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['names'].tolist(), f['bdes'], f['bact'], float(f['timestamp']))
+
+def snapshot_magnets(devices=None, timeout=2.0):
+    """
+    read BDES & BACT of all 'devices' (default: every SLC magnet) concurrently into a MagnetSnapshot
+    EPICS magnets can be included by passing them in 'devices'
+    """
+    if devices is None: devices = list(dict.fromkeys(ALL_SLC_MAGNETS))
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        bdes, bact = pool.map(lambda attr: get_magnets(devices, attr, timeout=timeout), ['BDES', 'BACT'])
+    to_float = lambda vals: [np.nan if v is None else v for v in vals]
+    return MagnetSnapshot(devices, to_float(bdes), to_float(bact))
+
+def restore_snapshot(snapshot, skip_unchanged=True, timeout=12):
+    """ set every magnet in 'snapshot' back to its saved BDES in a single set_magnets call """
+    valid = ~np.isnan(snapshot.bdes)
+    devices = [n for n, ok in zip(snapshot.names, valid) if ok]
+    return set_magnets(devices, snapshot.bdes[valid].tolist(), timeout=timeout, skip_unchanged=skip_unchanged)
 
 if __name__ == '__main__':
     # shutters UV laser ,test magnet trims
@@ -352,8 +265,9 @@ if __name__ == '__main__':
     print('Setting test magnets to 0.9*BDES ...')
     set_magnets(test_magnets, mod_bdes)
 
-    print('Pausing ...')
-    sleep(3)
+    print('Waiting for trims ...')
+    settle_times = track_trims(test_magnets, mod_bdes, timeout=10).result()
+    print(f'settle times [s]: {settle_times}')
 
     bacts = [
         get_pv(f'{test_magnets[0]}:BACT').get(),
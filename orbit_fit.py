@@ -1,88 +1,190 @@
+import weakref
 import numpy as np
-from epics import get_pv
+from time import time
+from epics import get_pv, caget_many
 from meme.model import Model
 from orbit import FacetOrbit
 import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
+from device_registry import REGISTRY
 
-AIDA_NAME_FLIP_LIST=  [
-    "BPMS:LI11:401", 
-    "BPMS:LI11:501",
-    "BPMS:LI11:601",
-    "BPMS:LI11:701",
-    "BPMS:LI11:801",
-    "BPMS:LI11:901",
-    "BPMS:LI12:201",
-    "BPMS:LI12:301",
-    "BPMS:LI12:401",
-    "BPMS:LI12:501",
-    "BPMS:LI12:601",
-    "BPMS:LI12:701",
-    "BPMS:LI12:801",
-    "BPMS:LI12:901",
-    "BPMS:LI13:201",
-    "BPMS:LI13:301",
-    "BPMS:LI13:401",
-    "BPMS:LI13:501",
-    "BPMS:LI13:601",
-    "BPMS:LI13:701",
-    "BPMS:LI13:801",
-    "BPMS:LI13:901",
-    "BPMS:LI14:201",
-    "BPMS:LI14:301",
-    "BPMS:LI14:401",
-    "BPMS:LI14:501",
-    "BPMS:LI14:601",
-    "BPMS:LI14:701",
-    "BPMS:LI14:901",
-    "BPMS:LI15:201",
-    "BPMS:LI15:301",
-    "BPMS:LI15:401",
-    "BPMS:LI15:501",
-    "BPMS:LI15:601",
-    "BPMS:LI15:701",
-    "BPMS:LI15:801",
-    "BPMS:LI15:901",
-    "BPMS:LI16:201",
-    "BPMS:LI16:301",
-    "BPMS:LI16:401",
-    "BPMS:LI16:501",
-    "BPMS:LI16:601",
-    "BPMS:LI16:701",
-    "BPMS:LI16:801",
-    "BPMS:LI16:901",
-    "BPMS:LI17:201",
-    "BPMS:LI17:301",
-    "BPMS:LI17:401",
-    "BPMS:LI17:501",
-    "BPMS:LI17:601",
-    "BPMS:LI17:701",
-    "BPMS:LI17:801",
-    "BPMS:LI17:901",
-    "BPMS:LI18:201",
-    "BPMS:LI18:301",
-    "BPMS:LI18:401",
-    "BPMS:LI18:501",
-    "BPMS:LI18:601",
-    "BPMS:LI18:701",
-    "BPMS:LI18:801",
-    "BPMS:LI18:901",
-    "BPMS:LI19:201",
-    "BPMS:LI19:301",
-    "BPMS:LI19:401",
-    "BPMS:LI19:501",
-    "BPMS:LI19:601",
-    "BPMS:LI19:701",
-    "BPMS:LI19:801",
-    "BPMS:LI19:901",
-    ]
-
-LI19_BLACKLIST = [
-    "BPMS:LI19:501",
-    "BPMS:LI19:601",
-    "BPMS:LI19:701",
-    "BPMS:LI19:901",
-    ]
+# BPMs with flipped AIDA names & LI19 blacklist, see devices.json
+AIDA_NAME_FLIP_LIST = REGISTRY.names('AIDA_NAME_FLIP_LIST')
+LI19_BLACKLIST = REGISTRY.names('LI19_BLACKLIST')
+
+# limit on the number of cached factorizations (one per z-range & sigma_0) per fitter
+MAX_CACHED_SOLVERS = 32
+
+
+class OrbitFitter:
+    """
+    least-squares orbit fitter for a fixed list of BPMs, model names & twiss parameters are
+    resolved once so each fit is a single masked matrix solve over a vector of readings
+
+    Parameters:
+      model: Model object providing twiss parameters
+      bpm_names: BPM device names (i.e. BPMS:LI11:401), in the order readings are given
+      z: BPM z positions in meters (for z-interval selection)
+
+    BPMs that are blacklisted or can't be found in the model are always excluded
+    """
+
+    def __init__(self, model, bpm_names, z):
+        self.names = list(bpm_names)
+        self.z = np.asarray(z, dtype=float)
+        n = len(self.names)
+        twiss = {k: np.full(n, np.nan) for k in ('beta_x', 'psi_x', 'eta_x', 'beta_y', 'psi_y', 'eta_y')}
+        for i, name in enumerate(self.names):
+            if REGISTRY.in_group(name, 'LI19_BLACKLIST'): continue
+            model_name = REGISTRY.model_name(name)
+            try:
+                model._get_indices_for_names([model_name], split_suffix=False, ignore_bad_names=False)
+                t = model.get_twiss(model_name)
+            except (IndexError, KeyError, AttributeError, ValueError):
+                print(f"Warning: Could not retrieve twiss parameters for BPM {name}. Excluding from fit.")
+                continue
+            for k in twiss: twiss[k][i] = np.squeeze(t[k])
+        self.twiss = twiss
+
+        # design matrix columns [sqrt(beta)*sin(psi), sqrt(beta)*cos(psi), eta] for each axis
+        self.G = {}
+        for axis in ('x', 'y'):
+            beta, psi, eta = twiss[f'beta_{axis}'], twiss[f'psi_{axis}'], twiss[f'eta_{axis}']
+            self.G[axis] = np.column_stack([np.sqrt(beta)*np.sin(psi), np.sqrt(beta)*np.cos(psi), eta])
+        self.valid = {axis: np.all(np.isfinite(G), axis=1) for axis, G in self.G.items()}
+        self._solvers = {}
+
+    def mask(self, axis='x', z_in=None, z_fin=None):
+        """ BPMs with model twiss (and within [z_in, z_fin] if given) """
+        m = self.valid[axis].copy()
+        if z_in is not None and z_fin is not None:
+            m &= (self.z >= z_in) & (self.z <= z_fin)
+        return m
+
+    def fit(self, readings, axis='x', sigma_0=0.0001, z_in=None, z_fin=None):
+        """
+        fit a vector of BPM readings in mm (NaN for missing values)
+
+        Returns:
+          p: array [A, B, C]
+          sigma_p: array of uncertainties [sigma_A, sigma_B, sigma_C]
+        """
+        p, sigma_p = self.fit_shots(np.asarray(readings, dtype=float)[np.newaxis], axis, sigma_0, z_in, z_fin)
+        return p[0], sigma_p[0]
+
+    def fit_shots(self, readings, axis='x', sigma_0=0.0001, z_in=None, z_fin=None):
+        """
+        fit many shots at once, 'readings' is an (n_shots x n_bpms) array in mm with NaN for missing values
+
+        shots where every selected BPM was read share one cached QR solve (one matrix product),
+        shots with dropouts are fit together with batched 3x3 masked normal equations
+
+        Returns:
+          p: (n_shots x 3) array of [A, B, C]
+          sigma_p: (n_shots x 3) array of uncertainties, both NaN for shots with fewer than 3 valid BPMs
+        """
+        nu = np.atleast_2d(np.asarray(readings, dtype=float)) / 1000  # convert mm to m
+        base = self.mask(axis, z_in, z_fin)
+        masks = np.isfinite(nu) & base
+        p = np.full((len(nu), 3), np.nan)
+        sigma_p = np.full((len(nu), 3), np.nan)
+        if np.count_nonzero(base) < 3: return p, sigma_p
+
+        full = np.count_nonzero(masks, axis=1) == np.count_nonzero(base)
+        if full.any():
+            solve, sigma = self._solver(axis, base, sigma_0)
+            p[full] = (nu[full][:, base] / sigma_0) @ solve.T
+            sigma_p[full] = sigma
+
+        partial = ~full & (np.count_nonzero(masks, axis=1) >= 3)
+        if partial.any():
+            p[partial], sigma_p[partial] = self._solve_masked(axis, nu[partial][:, base], masks[partial][:, base], sigma_0, base)
+        return p, sigma_p
+
+    def _solve_masked(self, axis, nu, masks, sigma_0, base):
+        """
+        per-shot least squares from the normal equations (G_m^T G_m) p = G_m^T nu_m, built for all
+        shots at once as mask-weighted sums of the per-BPM outer products, NaN for singular shots
+        """
+        W = self.G[axis][base] / sigma_0
+        w = masks.astype(float)
+        A = (w @ (W[:, :, np.newaxis] * W[:, np.newaxis, :]).reshape(-1, 9)).reshape(-1, 3, 3)
+        b = (np.where(masks, nu, 0.0) / sigma_0) @ W
+
+        p = np.full((len(nu), 3), np.nan)
+        sigma_p = np.full((len(nu), 3), np.nan)
+        # equilibrate before solving, the columns of G differ by orders of magnitude
+        d = np.sqrt(np.einsum('nii->ni', A))
+        ok = np.all(d > 0, axis=1)
+        An = A[ok] / (d[ok][:, :, np.newaxis] * d[ok][:, np.newaxis, :])
+        ok_idx = np.flatnonzero(ok)
+        good = np.linalg.cond(An) < 1 / np.finfo(float).eps
+        if not good.any(): return p, sigma_p
+        ok_idx, An, dn = ok_idx[good], An[good], d[ok][good]
+        An_inv = np.linalg.inv(An)
+        cov = An_inv / (dn[:, :, np.newaxis] * dn[:, np.newaxis, :])
+        p[ok_idx] = np.einsum('nij,nj->ni', cov, b[ok_idx])
+        sigma_p[ok_idx] = np.sqrt(np.einsum('nii->ni', cov))
+        return p, sigma_p
+
+    def _solver(self, axis, m, sigma_0):
+        """
+        least-squares solve matrix R^-1 Q^T & parameter uncertainties for the BPMs in mask 'm',
+        from a QR factorization of the weighted design matrix, cached per mask
+        """
+        key = (axis, sigma_0, m.tobytes())
+        if key not in self._solvers:
+            # drop the oldest entry, only the z-range/sigma_0 combinations in use are cached
+            if len(self._solvers) >= MAX_CACHED_SOLVERS: del self._solvers[next(iter(self._solvers))]
+            Q, R = np.linalg.qr(self.G[axis][m] / sigma_0)
+            R_inv = np.linalg.inv(R)
+            # covariance is R^-1 R^-T, so the uncertainties are the row norms of R^-1
+            self._solvers[key] = (R_inv @ Q.T, np.sqrt(np.sum(R_inv**2, axis=1)))
+        return self._solvers[key]
+
+
+# fitters cached per model & BPM list, see get_fitter
+_fitters = weakref.WeakKeyDictionary()
+
+def get_fitter(model, names, z):
+    """ cached OrbitFitter for 'model' and a list of BPM names & z positions """
+    key = tuple(names)
+    fitters = _fitters.setdefault(model, {})
+    if key not in fitters: fitters[key] = OrbitFitter(model, key, z)
+    return fitters[key]
+
+
+class OrbitSnapshot:
+    """
+    x/y readings of every BPM in mm (NaN if unreadable) & their z positions in meters,
+    read with one bulk CA request so a fit & its plot see the same orbit
+    """
+
+    def __init__(self, names, x, y, z, timestamp=None):
+        self.names = list(names)
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.z = np.asarray(z, dtype=float)
+        self.timestamp = time() if timestamp is None else timestamp
+
+    def __len__(self): return len(self.names)
+
+    def readings(self, axis='x'): return self.x if axis == 'x' else self.y
+
+    @classmethod
+    def acquire(cls, live_orbit, timeout=2.0):
+        """ read all BPMs of a FacetOrbit in one caget_many call """
+        bpms = live_orbit.bpms
+        pvnames = [bpm.x_pv_obj.pvname for bpm in bpms] + [bpm.y_pv_obj.pvname for bpm in bpms]
+        timestamp = time()
+        vals = [np.nan if v is None else v for v in caget_many(pvnames, timeout=timeout)]
+        n = len(bpms)
+        return cls([bpm.name for bpm in bpms], vals[:n], vals[n:], [bpm.z for bpm in bpms], timestamp)
+
+
+def _snapshot(orbit):
+    """ 'orbit' may be an OrbitSnapshot or a live orbit to read one from """
+    return orbit if isinstance(orbit, OrbitSnapshot) else OrbitSnapshot.acquire(orbit)
 
 
 def fit_orbit(live_orbit, model, sigma_0=0.0001, axis='x', z_in=None, z_fin=None):
@@ -90,7 +192,7 @@ def fit_orbit(live_orbit, model, sigma_0=0.0001, axis='x', z_in=None, z_fin=None
     Fits the BPM orbit data to extract trajectory parameters A, B, C.
     
     Parameters:
-      live_orbit
+      live_orbit: OrbitSnapshot, or a live orbit to take one from
       model
       sigma_0: placehokder BPM resolution in meters
       axis: 'x' or 'y' (which orbit to fit)
@@ -99,69 +201,9 @@ def fit_orbit(live_orbit, model, sigma_0=0.0001, axis='x', z_in=None, z_fin=None
       p: array [A, B, C]
       sigma_p: array of uncertainties [sigma_A, sigma_B, sigma_C]
     """
-    bpms = live_orbit.bpms
-    B_list = []
-    z_list = []
-    
-    for bpm in bpms:
-
-        # Filter BPMs based on z-interval if specified
-        if z_in is not None and z_fin is not None:
-            if bpm.z < z_in or bpm.z > z_fin:
-                continue
-        
-        # get the measurement based on the axis
-        if axis == 'x':
-            nu = bpm.x_pv_obj.get()
-        elif axis == 'y':
-            nu = bpm.y_pv_obj.get()
-            
-        if nu is None or np.isnan(nu):
-            continue
-        nu /= 1000  # convert mm to m
-        
-        # Check if BPM name exists in the model
-        bpm_name = bpm.name
-        if bpm_name in LI19_BLACKLIST: continue
-        if bpm_name in AIDA_NAME_FLIP_LIST:
-            ns = bpm_name.split(':')
-            if bpm_name == 'BPMS:LI13:301':
-                bpm_name = f'{ns[1]}:{ns[0]}:303'
-            else:
-                bpm_name = f'{ns[1]}:{ns[0]}:{ns[2]}'
-
-        model._get_indices_for_names([bpm_name], split_suffix=False, ignore_bad_names=False)
-        
-        twiss = model.get_twiss(bpm_name)
-        if axis == 'x':
-            beta = twiss['beta_x']
-            psi  = twiss['psi_x']
-            eta  = twiss['eta_x']
-        else:  # axis == 'y'
-            beta = twiss['beta_y']
-            psi  = twiss['psi_y']
-            eta  = twiss['eta_y']
-        
-        g1 = np.sqrt(beta) * np.sin(psi)
-        g2 = np.sqrt(beta) * np.cos(psi)
-        g3 = eta
-        sigma_nu = sigma_0
-        
-        B_row = [g1 / sigma_nu, g2 / sigma_nu, g3 / sigma_nu]
-        z_nu = nu / sigma_nu
-        
-        B_list.append(B_row)
-        z_list.append(z_nu)
-    
-    
-    B = np.array(B_list)
-    z = np.array(z_list)
-    
-    T = np.linalg.inv(B.T @ B)
-    p = T @ B.T @ z
-    sigma_p = np.sqrt(np.diag(T))
-    
-    return p, sigma_p
+    snap = _snapshot(live_orbit)
+    fitter = get_fitter(model, snap.names, snap.z)
+    return fitter.fit(snap.readings(axis), axis=axis, sigma_0=sigma_0, z_in=z_in, z_fin=z_fin)
 
 
 def plot_orbit_fit(live_orbit, model, p, sigma_p, sigma_0=0.0001, num_points=1000, axis='x', z_in=None, z_fin=None, ax=None):
@@ -169,7 +211,7 @@ def plot_orbit_fit(live_orbit, model, p, sigma_p, sigma_0=0.0001, num_points=100
     Plots the measured BPM data and the fitted trajectory within a specified z-interval.
     
     Parameters:
-      live_orbit: Orbit data object containing BPMs
+      live_orbit: OrbitSnapshot (i.e. the one used for the fit), or a live orbit to take one from
       model: Model object providing twiss parameters
       p: Array of fitted trajectory parameters [A, B, C]
       sigma_p: Array of uncertainties [sigma_A, sigma_B, sigma_C]
@@ -184,64 +226,25 @@ def plot_orbit_fit(live_orbit, model, p, sigma_p, sigma_0=0.0001, num_points=100
       ax: Matplotlib axis with the plot
     """
     
-    bpms = live_orbit.bpms
+    snap = _snapshot(live_orbit)
+    fitter = get_fitter(model, snap.names, snap.z)
+    nu = snap.readings(axis)
+    measured = np.isfinite(nu)
     
     # Collect twiss data for interpolation from all BPMs with valid measurements
-    s_known = []
-    beta_known = []
-    psi_known = []
-    eta_known = []
-    
-    for bpm in bpms:
-        if axis == 'x':
-            nu = bpm.x_pv_obj.get()
-        elif axis == 'y':
-            nu = bpm.y_pv_obj.get()
-          
-        if nu is None or np.isnan(nu):
-            continue
-        
-        try:
-            twiss = model.get_twiss(bpm.name)
-            if axis == 'x':
-                beta = twiss['beta_x']
-                psi  = twiss['psi_x']
-                eta  = twiss['eta_x']
-            else:
-                beta = twiss['beta_y']
-                psi  = twiss['psi_y']
-                eta  = twiss['eta_y']
-            s_known.append(bpm.z)
-            beta_known.append(beta)
-            psi_known.append(psi)
-            eta_known.append(eta)
-        except (IndexError, KeyError, AttributeError):
-            print(f"Warning: Could not retrieve twiss parameters for BPM {bpm.name}. Skipping for interpolation.")
-            continue
+    known = measured & fitter.valid[axis]
+    s_known = snap.z[known]
+    beta_known = fitter.twiss[f'beta_{axis}'][known]
+    psi_known = fitter.twiss[f'psi_{axis}'][known]
+    eta_known = fitter.twiss[f'eta_{axis}'][known]
     
     # Collect measurements for plotting within the specified z-interval
-    s_bpm = []
-    nu_bpm = []
-    sigma_bpm = []
-    
-    for bpm in bpms:
-        if axis == 'x':
-            nu = bpm.x_pv_obj.get()
-        elif axis == 'y':
-            nu = bpm.y_pv_obj.get()
-          
-        if nu is None or np.isnan(nu):
-            continue
-        nu /= 1000  # Convert mm to m
-        
-        # Filter BPMs based on z-interval if specified
-        if z_in is not None and z_fin is not None:
-            if bpm.z < z_in or bpm.z > z_fin:
-                continue
-        
-        s_bpm.append(bpm.z)
-        nu_bpm.append(nu)
-        sigma_bpm.append(sigma_0)
+    in_range = measured.copy()
+    if z_in is not None and z_fin is not None:
+        in_range &= (snap.z >= z_in) & (snap.z <= z_fin)
+    s_bpm = snap.z[in_range]
+    nu_bpm = nu[in_range] / 1000  # Convert mm to m
+    sigma_bpm = np.full(len(s_bpm), sigma_0)
     
     # Determine the range for the fitted trajectory
     if z_in is not None and z_fin is not None:
@@ -322,19 +325,22 @@ if __name__ == '__main__':
     live_orbit = FacetOrbit(ignore_bad_bpms=True, rate_suffix='TH', scp_suffix='57')
     live_orbit.connect()
 
+    # one orbit acquisition for both fits & plots
+    snap = OrbitSnapshot.acquire(live_orbit)
+
     # Define z-interval
     z_in = 1000
     z_fin = 1500  
 
     # Fit x orbit with z-interval
-    p_x, sigma_p_x = fit_orbit(live_orbit, model, sigma_0=0.0001, axis='x', z_in=z_in, z_fin=z_fin)
+    p_x, sigma_p_x = fit_orbit(snap, model, sigma_0=0.0001, axis='x', z_in=z_in, z_fin=z_fin)
     print("X Orbit Fit:")
     print(f"A = {p_x[0]:.6f} ± {sigma_p_x[0]:.6f}")
     print(f"B = {p_x[1]:.6f} ± {sigma_p_x[1]:.6f}")
     print(f"C = {p_x[2]:.6f} ± {sigma_p_x[2]:.6f}")
 
     # Fit y orbit with z-interval
-    p_y, sigma_p_y = fit_orbit(live_orbit, model, sigma_0=0.0001, axis='y', z_in=z_in, z_fin=z_fin)
+    p_y, sigma_p_y = fit_orbit(snap, model, sigma_0=0.0001, axis='y', z_in=z_in, z_fin=z_fin)
     print("\nY Orbit Fit:")
     print(f"A = {p_y[0]:.6f} ± {sigma_p_y[0]:.6f}")
     print(f"B = {p_y[1]:.6f} ± {sigma_p_y[1]:.6f}")
@@ -342,8 +348,8 @@ if __name__ == '__main__':
 
     # Create a figure with two subplots to display both fits
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 12))
-    plot_orbit_fit(live_orbit, model, p_x, sigma_p_x, sigma_0=0.0001, num_points=1000, axis='x', z_in=z_in, z_fin=z_fin, ax=ax1)
-    plot_orbit_fit(live_orbit, model, p_y, sigma_p_y, sigma_0=0.0001, num_points=1000, axis='y', z_in=z_in, z_fin=z_fin, ax=ax2)
+    plot_orbit_fit(snap, model, p_x, sigma_p_x, sigma_0=0.0001, num_points=1000, axis='x', z_in=z_in, z_fin=z_fin, ax=ax1)
+    plot_orbit_fit(snap, model, p_y, sigma_p_y, sigma_0=0.0001, num_points=1000, axis='y', z_in=z_in, z_fin=z_fin, ax=ax2)
     plt.tight_layout()
     plt.show()
 
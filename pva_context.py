@@ -0,0 +1,83 @@
+# process-wide shared p4p client contexts
+
+import asyncio
+import threading
+from collections import Counter
+
+"""
+every module & widget gets its PVA client from here instead of creating its own Context,
+contexts are created on first use so importing a module has no network side effects
+"""
+
+_contexts = {}
+_async_contexts = {}
+_lock = threading.Lock()
+_stats = Counter()
+
+def get_context(provider='pva'):
+    """ shared p4p.client.thread Context for 'provider', created on first use """
+    with _lock:
+        ctx = _contexts.get(provider)
+        if ctx is None:
+            from p4p.client.thread import Context
+            ctx = _contexts[provider] = Context(provider)
+            _stats['created'] += 1
+        else:
+            _stats['reused'] += 1
+        return ctx
+
+def get_async_context(provider='pva'):
+    """
+    shared p4p.client.asyncio Context for 'provider' bound to the running event loop,
+    a context left over from a previous event loop is closed & replaced
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        ctx, ctx_loop = _async_contexts.get(provider, (None, None))
+        if ctx is None or ctx_loop is not loop:
+            if ctx is not None: _close(ctx)
+            from p4p.client.asyncio import Context as AsyncContext
+            ctx = AsyncContext(provider)
+            _async_contexts[provider] = (ctx, loop)
+            _stats['async_created'] += 1
+        else:
+            _stats['async_reused'] += 1
+        return ctx
+
+async def arpc(name, value, timeout, provider='pva'):
+    """
+    rpc on the shared asyncio Context, bounded by 'timeout' seconds
+    (the asyncio Context.rpc has no timeout argument, so a stuck server would hang the await forever)
+    """
+    return await asyncio.wait_for(get_async_context(provider).rpc(name, value), timeout)
+
+def context_stats():
+    """ counts of created/reused contexts & the providers currently open """
+    with _lock:
+        return dict(_stats, providers=sorted(_contexts), async_providers=sorted(_async_contexts))
+
+def close_all():
+    """ close all shared threaded & asyncio contexts, the next get_(async_)context call opens a new one """
+    with _lock:
+        for ctx in _contexts.values(): _close(ctx)
+        for ctx, _ in _async_contexts.values(): _close(ctx)
+        _contexts.clear()
+        _async_contexts.clear()
+
+def _close(ctx):
+    # closing must not stop the others from closing, i.e. an asyncio context whose loop is gone
+    try:
+        ctx.close()
+    except Exception as e:
+        print(f'could not close {ctx}: {e}')
+
+class LazyContext:
+    """
+    stand-in for a module-level Context, i.e. ctx = LazyContext('pva'),
+    attribute access is forwarded to the shared context for 'provider'
+    """
+
+    def __init__(self, provider='pva'):
+        self.provider = provider
+
+    def __getattr__(self, attr): return getattr(get_context(self.provider), attr)
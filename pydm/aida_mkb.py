@@ -3,14 +3,14 @@ import os
 import sys
 from functools import partial
 from PyQt5.QtGui import QDoubleValidator
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
 from PyQt5.QtWidgets import QFrame, QGridLayout, QPushButton, QLineEdit, QSlider, QLabel
 from epics import get_pv
 
 SELF_PATH = os.path.dirname(os.path.abspath(__file__))
 REPO_ROOT = os.path.join(*os.path.split(SELF_PATH)[:-1])
 sys.path.append(REPO_ROOT)
-from slc_mkb import set_mkb
+from slc_mkb import mkb_dispatcher
 
 STYLE_BRD_GREEN = """
 QFrame{
@@ -30,6 +30,8 @@ border-style: solid;
 }
 """
 
+STYLE_TEXT_RED = "color: rgb(220,0,0);"
+
 STYLE_BRD_BLK = """
 QFrame{
 background-color: rgb(230,230,230);
@@ -50,10 +52,16 @@ REFRESH_MS = 200
 class AIDAMKBController(QFrame):
     """ L2 phase knob, can click to increment/decrement or type deltas """
 
+    # emitted from the multiknob writer thread as (delta) / (delta, exception)
+    knob_committed = pyqtSignal(float)
+    knob_failed = pyqtSignal(float, object)
+
     def __init__(self, mkname, lim_lo=KNOB_LOW, lim_hi=KNOB_HIGH, parent=None, args=None):
         QFrame.__init__(self, parent=parent)
         self.init_ui()
-        self.displacement = 0.0
+        self.knob = None
+        self.knob_committed.connect(self.on_knob_commit)
+        self.knob_failed.connect(self.on_knob_error)
         self.mkname = mkname
         self.update_readbacks()
 
@@ -140,13 +148,22 @@ class AIDAMKBController(QFrame):
     @mkname.setter
     def mkname(self, value):
         self._mkname = value
-        self.displacement = 0.0
+        if self.knob is not None: self.knob.detach(self.knob_committed.emit, self.knob_failed.emit)
+        self.knob = mkb_dispatcher(value, on_commit=self.knob_committed.emit, on_error=self.knob_failed.emit)
+        self.origin = self.knob.total
+        self.ctl_manual.setStyleSheet('')
+        self.ctl_manual.setToolTip('')
         self.set_mkname.setText(value)
         self.set_step.setText(f'{DEFAULT_STEP_SIZE:.2f}')
         self.set_lim_lo.setText(f'{KNOB_LOW:.2f}')
         self.set_lim_hi.setText(f'{KNOB_HIGH:.2f}')
         self.update_readbacks()
     
+    @property
+    def displacement(self):
+        """ knob delta since it was selected, written + queued (failed deltas are not included) """
+        return self.knob.total - self.origin
+
     @property
     def step_size(self): return float(self.set_step.text())
 
@@ -165,9 +182,19 @@ class AIDAMKBController(QFrame):
         self.update(float(self.ctl_manual.text()) - self.displacement)
 
     def update(self, delta):
-        """ write & track knob delta """
-        self.displacement += delta
-        set_mkb(self.mkname, delta)
+        """ queue a knob delta for writing, the rpc runs in the background """
+        self.knob.submit(delta)
+        self.update_readbacks()
+
+    def on_knob_commit(self, delta):
+        self.ctl_manual.setStyleSheet('')
+        self.ctl_manual.setToolTip('')
+        self.update_readbacks()
+
+    def on_knob_error(self, delta, e):
+        """ the failed delta was dropped by the dispatcher, show the corrected total & flag the error """
+        self.ctl_manual.setStyleSheet(STYLE_TEXT_RED)
+        self.ctl_manual.setToolTip(f'multiknob {self.mkname} failed to move by {delta:.2f}: {e}')
         self.update_readbacks()
 
     def update_readbacks(self, **kw):
@@ -0,0 +1,138 @@
+# PyDM data plugin for SLC database values that are only available through AIDA-PVA rpc
+#
+# channels look like aida://YCOR:LI13:303:BACT or aida://LI11:FBCK:26:HSTA?type=INTEGER&period=0.5
+# - type: AIDA return type, default DOUBLE
+# - period: poll period in seconds, default DEFAULT_PERIOD
+#
+# every channel with the same period is read in one batched get_aidapva_many call per tick
+# & widgets only get new values when they change
+# to use, add this directory to PYDM_DATA_PLUGINS_PATH
+
+import os
+import sys
+import threading
+import numpy as np
+from urllib.parse import parse_qs
+from traceback import print_exc
+from pydm.data_plugins.plugin import PyDMPlugin, PyDMConnection
+
+SELF_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.join(*os.path.split(SELF_PATH)[:-1])
+sys.path.append(REPO_ROOT)
+from slc_mags import get_aidapva_many
+
+DEFAULT_PERIOD = 1.0
+DEFAULT_TYPE = 'DOUBLE'
+
+def _parse_address(address):
+    """ 'DEV:ATTR?type=..&period=..' --> (pv, return type, period) """
+    pv, _, query = address.partition('?')
+    opts = {k: v[-1] for k, v in parse_qs(query).items()}
+    return pv, opts.get('type', DEFAULT_TYPE).upper(), float(opts.get('period', DEFAULT_PERIOD))
+
+def _changed(old, new):
+    if old is None: return True
+    if isinstance(new, np.ndarray) or isinstance(old, np.ndarray):
+        return not np.array_equal(old, new)
+    return old != new
+
+
+class GroupPoller:
+    """ polls every connection with the same period in one batch on a background thread """
+
+    def __init__(self, period):
+        self.period = period
+        self.connections = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._stop.set()
+
+    def add(self, connection):
+        with self._lock:
+            self.connections.add(connection)
+            if self._stop.is_set():
+                self._stop = threading.Event()
+                threading.Thread(target=self._run, args=(self._stop,), daemon=True).start()
+
+    def remove(self, connection):
+        with self._lock:
+            self.connections.discard(connection)
+            if not self.connections: self._stop.set()
+
+    def poll(self):
+        with self._lock: connections = list(self.connections)
+        if not connections: return
+        values, _ = get_aidapva_many([c.pv for c in connections], [c.return_type for c in connections],
+            timeout=max(1.0, self.period))
+        for c, value in zip(connections, values): c.update(value)
+
+    def _run(self, stop):
+        while not stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                print_exc()
+            stop.wait(self.period)
+
+_pollers = {}
+_pollers_lock = threading.Lock()
+
+def poller(period):
+    """ shared GroupPoller for a poll period """
+    with _pollers_lock:
+        if period not in _pollers: _pollers[period] = GroupPoller(period)
+        return _pollers[period]
+
+
+class AidaConnection(PyDMConnection):
+
+    def __init__(self, channel, address, protocol=None, parent=None):
+        super().__init__(channel, address, protocol, parent)
+        self.pv, self.return_type, self.period = _parse_address(address)
+        self.value = None
+        self.connected = False
+        self.add_listener(channel)
+        poller(self.period).add(self)
+
+    def update(self, value):
+        """ called from the poller thread, None means the read failed """
+        if value is None:
+            if self.connected:
+                self.connected = False
+                self.connection_state_signal.emit(False)
+            return
+        if not self.connected:
+            self.connected = True
+            self.connection_state_signal.emit(True)
+            self.write_access_signal.emit(False)
+        if _changed(self.value, value):
+            self.value = value
+            self.send_value()
+
+    def send_value(self):
+        value = self.value
+        if isinstance(value, (list, tuple, np.ndarray)):
+            self.new_value_signal[np.ndarray].emit(np.asarray(value))
+        elif isinstance(value, (bool, int, np.integer)):
+            self.new_value_signal[int].emit(int(value))
+        elif isinstance(value, (float, np.floating)):
+            self.new_value_signal[float].emit(float(value))
+        else:
+            self.new_value_signal[str].emit(str(value))
+
+    def add_listener(self, channel):
+        super().add_listener(channel)
+        # new listeners get the current state right away instead of waiting for a change
+        self.connection_state_signal.emit(self.connected)
+        if self.connected:
+            self.write_access_signal.emit(False)
+            self.send_value()
+
+    def close(self):
+        poller(self.period).remove(self)
+        super().close()
+
+
+class AidaPlugin(PyDMPlugin):
+    protocol = 'aida'
+    connection_class = AidaConnection
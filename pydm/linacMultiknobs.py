@@ -1,8 +1,9 @@
 import os
 import sys
+from time import monotonic
 from functools import partial
 from PyQt5.QtGui import QDoubleValidator
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
 from PyQt5.QtWidgets import QFrame, QGridLayout, QPushButton, QLineEdit, QSlider, QLabel
 from epics import get_pv
 
@@ -10,7 +11,7 @@ from epics import get_pv
 SELF_PATH = os.path.dirname(os.path.abspath(__file__))
 REPO_ROOT = os.path.join(*os.path.split(SELF_PATH)[:-1])
 sys.path.append(REPO_ROOT)
-from slc_mkb import set_mkb
+from slc_mkb import mkb_dispatcher
 
 STYLE_BRD_GREEN = """
 QFrame{
@@ -30,6 +31,8 @@ border-style: solid;
 }
 """
 
+STYLE_TEXT_RED = "color: rgb(220,0,0);"
+
 STYLE_BRD_BLK = """
 QFrame{
 background-color: rgb(230,230,230);
@@ -45,16 +48,27 @@ PHASE_HIGH = 0
 # default increment in degS
 DEFAULT_STEP_SIZE = 0.5
 
-REFRESH_MS = 1000
+# readbacks follow CA monitors, repaints are limited to one per MIN_REPAINT_MS
+MIN_REPAINT_MS = 100
 
 class l2PhaseController(QFrame):
     """ L2 phase knob, can click to increment/decrement or type deltas """
 
+    # emitted from CA monitor callbacks, moves readback updates to the GUI thread
+    readback_changed = pyqtSignal()
+
+    # emitted from the multiknob writer thread as (delta) / (delta, exception)
+    knob_committed = pyqtSignal(float)
+    knob_failed = pyqtSignal(float, object)
+
     def __init__(self, parent=None, args=None):
         QFrame.__init__(self, parent=parent)
 
         self.mkname = 'l2_phase' # l2 phase multiknob for SB12/13/14
-        self.displacement = 0.0  # total delta since initialization
+        self.knob_committed.connect(self.on_knob_commit)
+        self.knob_failed.connect(self.on_knob_error)
+        self.knob = mkb_dispatcher(self.mkname, on_commit=self.knob_committed.emit, on_error=self.knob_failed.emit)
+        self.origin = self.knob.total  # knob position at initialization
 
         self.ctl_incr = QPushButton('+')
         self.ctl_decr = QPushButton('-')
@@ -111,16 +125,19 @@ class l2PhaseController(QFrame):
         self.l2_indicator.setTickPosition(QSlider.TicksBelow)
         self.l2_indicator.setInvertedAppearance(True)
 
+        # latest monitored values & their averages, updated only when a PV changes
+        self.values = {'des': [None]*3, 'act': [None]*3}
+        self.averages = {'des': None, 'act': None}
         self.PVs = {
             'des': [
-                get_pv('LI12:SBST:1:PDES'),
-                get_pv('LI13:SBST:1:PDES'),
-                get_pv('LI14:SBST:1:PDES'),
+                get_pv('LI12:SBST:1:PDES', callback=partial(self.on_value, 'des', 0)),
+                get_pv('LI13:SBST:1:PDES', callback=partial(self.on_value, 'des', 1)),
+                get_pv('LI14:SBST:1:PDES', callback=partial(self.on_value, 'des', 2)),
                 ],
             'act': [
-                get_pv('LI12:SBST:1:PHAS'),
-                get_pv('LI13:SBST:1:PHAS'),
-                get_pv('LI14:SBST:1:PHAS'),
+                get_pv('LI12:SBST:1:PHAS', callback=partial(self.on_value, 'act', 0)),
+                get_pv('LI13:SBST:1:PHAS', callback=partial(self.on_value, 'act', 1)),
+                get_pv('LI14:SBST:1:PHAS', callback=partial(self.on_value, 'act', 2)),
                 ],
             }
 
@@ -154,25 +171,46 @@ class l2PhaseController(QFrame):
         L.setContentsMargins(0,0,0,0)
         self.setLayout(L)
 
+        self.last_repaint = 0.0
+        self.repaint_timer = QTimer(self)
+        self.repaint_timer.setSingleShot(True)
+        self.repaint_timer.setInterval(MIN_REPAINT_MS)
+        self.repaint_timer.timeout.connect(self.update_readbacks)
+        self.readback_changed.connect(self.schedule_repaint)
         self.update_readbacks()
-        self.refresh_timer = QTimer(self)
-        self.refresh_timer.start()
-        self.refresh_timer.setInterval(REFRESH_MS)
-        self.refresh_timer.timeout.connect(self.update_readbacks)
         return
 
     @property
     def step_size(self): return float(self.set_step.text())
 
     @property
-    def l2_pdes(self): return sum([pv.get() for pv in self.PVs['des']]) / 3.0
+    def l2_pdes(self): return self.averages['des']
 
     @property
-    def l2_pact(self): return sum([pv.get() for pv in self.PVs['act']]) / 3.0
+    def l2_pact(self): return self.averages['act']
 
     @property
     def phase_err(self): return self.l2_pdes - self.l2_pact
 
+    @property
+    def displacement(self):
+        """ total delta since initialization, written + queued (failed deltas are not included) """
+        return self.knob.total - self.origin
+
+    def on_value(self, key, i, value=None, **kw):
+        """ CA monitor callback, caches the value & recomputes the average for 'key' """
+        self.values[key][i] = value
+        vals = self.values[key]
+        self.averages[key] = None if None in vals else sum(vals) / 3.0
+        self.readback_changed.emit()
+
+    def schedule_repaint(self):
+        """ repaint now, or at the end of the MIN_REPAINT_MS window if one just happened """
+        if self.repaint_timer.isActive(): return
+        wait_ms = MIN_REPAINT_MS - 1000*(monotonic() - self.last_repaint)
+        if wait_ms <= 0: self.update_readbacks()
+        else: self.repaint_timer.start(int(wait_ms))
+
     def incr(self): self.update_phase(self.step_size)
 
     def decr(self): self.update_phase(-1 * self.step_size)   
@@ -181,15 +219,27 @@ class l2PhaseController(QFrame):
     def update_phase_manual(self): self.update_phase(float(self.ctl_manual.text()) - self.displacement)
 
     def update_phase(self, delta):
-        """ writes & tracks phase delta """
-        self.displacement += delta
-        set_mkb(self.mkname, delta)
+        """ queues a phase delta for writing, the rpc runs in the background """
+        self.knob.submit(delta)
         self.update_readbacks()
 
+    def on_knob_commit(self, delta):
+        self.ctl_manual.setStyleSheet('')
+        self.ctl_manual.setToolTip('')
+        self.schedule_repaint()
+
+    def on_knob_error(self, delta, e):
+        """ the failed delta was dropped by the dispatcher, show the corrected total & flag the error """
+        self.ctl_manual.setStyleSheet(STYLE_TEXT_RED)
+        self.ctl_manual.setToolTip(f'multiknob {self.mkname} failed to move by {delta:.2f}: {e}')
+        self.schedule_repaint()
+
     def reset(self): self.update_phase(-1 * self.displacement)
 
     def update_readbacks(self, **kw):
+        self.last_repaint = monotonic()
         self.ctl_manual.setText(f'{self.displacement:.1f}')
+        if self.l2_pdes is None or self.l2_pact is None: return
         self.l2_des_rbv.setText(f'{self.l2_pdes:.1f}')
         self.l2_act_rbv.setText(f'{self.l2_pact:.1f}')
         style = STYLE_BRD_GREEN
@@ -1,7 +1,14 @@
-from p4p.client.thread import Context
+import threading
+import numpy as np
+from traceback import print_exc
+from concurrent.futures import ThreadPoolExecutor
+from pva_context import LazyContext, arpc
 from p4p.nt import NTURI, NTTable
 
-CTX = Context('pva')
+CTX = LazyContext('pva')
+
+# default limit on the number of concurrent TACT rpc calls for bulk activate/deactivate
+MAX_INFLIGHT = 8
 
 F2_ALL_KLYS = []
 for s in range(11,20):
@@ -27,22 +34,50 @@ NTT_ALL_KLYS = NTTable([
 
 def get_klys_stat(klys_channel):
     """ get status for a single klytron, returns an int """
-    ntval = URI_KLYS_TACT.wrap(
-        scheme='pva', path=klys_channel, kws={'TYPE':'SHORT', 'BEAM':'10'}
-        )
-    res = CTX.rpc(klys_channel, ntval)
+    res = CTX.rpc(klys_channel, _klys_stat_request(klys_channel))
     return res.raw.value
 
 
 def get_all_klys_stat():
     """ get the current status of all SLC klystrons in L2 & L3 as a dict """
-    ntval = URI_ALL_KLYS.wrap(
-        scheme='pva', path='KLYSTRONGET:TACT', kws={'DEVICES':F2_ALL_KLYS, 'BEAM':'10'}
-        )
-    res = CTX.rpc('KLYSTRONGET:TACT', ntval)
-    k_status = {}
-    for r in NTT_ALL_KLYS.unwrap(res): k_status[r['name']] = r
-    return k_status
+    res = CTX.rpc('KLYSTRONGET:TACT', _all_klys_stat_request())
+    return _unpack_all_klys_stat(res)
+
+# structured array version of the NTT_ALL_KLYS table, one row per klystron
+KLYS_STAT_DTYPE = np.dtype([
+    ('name', 'U16'),
+    ('opstat', '?'),
+    ('status', 'i1'),
+    ('accel', '?'),
+    ('standby', '?'),
+    ('bad', '?'),
+    ('sled', '?'),
+    ('sleded', '?'),
+    ('pampl', '?'),
+    ('pphas', '?'),
+    ])
+
+def get_all_klys_stat_array():
+    """ get the current status of all SLC klystrons in L2 & L3 as a KLYS_STAT_DTYPE array """
+    res = CTX.rpc('KLYSTRONGET:TACT', _all_klys_stat_request())
+    return _klys_stat_array(res)
+
+def klys_sectors(stat):
+    """ linac sector of each row, i.e. 11 for KLYS:LI11:31 """
+    return np.array([int(name.split(':')[1][2:]) for name in stat['name']], dtype=int)
+
+def onbeam_by_sector(stat, sectors=range(11,20)):
+    """ number of klystrons accelerating (and not bad) in each sector as a {sector: count} dict """
+    onbeam = stat['accel'] & ~stat['bad']
+    counts = np.bincount(klys_sectors(stat)[onbeam], minlength=max(sectors)+1)
+    return {s: int(counts[s]) for s in sectors}
+
+def diff_klys_stat(old, new):
+    """ rows of 'new' that are missing from or differ from the 'old' status array """
+    _, i_old, i_new = np.intersect1d(old['name'], new['name'], return_indices=True)
+    changed = np.ones(len(new), dtype=bool)
+    changed[i_new] = old[i_old] != new[i_new]
+    return new[changed]
 
 # activate a klystron on beamcode 10
 def react(klys_channel): return _set_klys(klys_channel)
@@ -50,10 +85,193 @@ def react(klys_channel): return _set_klys(klys_channel)
 # deactivate klystron on beamcode 10
 def deact(klys_channel): return _set_klys(klys_channel, react=False)
 
+def set_klys_states(states, max_inflight=MAX_INFLIGHT, verify=True):
+    """
+    activate/deactivate many klystrons on beamcode 10 with concurrent TACT rpcs
+    (at most 'max_inflight' at a time)
+
+    Args:
+    - states (dict): {klys_channel: True to activate, False to deactivate}
+    - verify (bool) [True]: read back all klystrons with one get_all_klys_stat call
+
+    Returns:
+    - results: dict of {klys_channel: rpc result}, None for stations whose rpc failed
+    - errors: dict of {klys_channel: exception} for failed rpcs, or whose
+      accel state doesn't match the request (or couldn't be read back) after the readback
+
+    Example:
+      results, errors = set_klys_states({'KLYS:LI11:31': False, 'KLYS:LI11:41': True})
+    """
+    results, errors = {}, {}
+    if not states: return results, errors
+    with ThreadPoolExecutor(max_workers=max(1, min(max_inflight, len(states)))) as pool:
+        futures = {k: pool.submit(_set_klys, k, react) for k, react in states.items()}
+        for k, f in futures.items():
+            try:
+                results[k] = f.result()
+            except Exception as e:
+                results[k] = None
+                errors[k] = e
+    if verify:
+        try:
+            stat = get_all_klys_stat()
+        except Exception as e:
+            # the stations were already set, report the failed readback per station
+            for k in states:
+                if k not in errors: errors[k] = RuntimeError(f'{k} readback failed: {e}')
+            return results, errors
+        for k, react in states.items():
+            if k in errors: continue
+            row = stat.get(k)
+            if row is None or bool(row['accel']) != react:
+                errors[k] = RuntimeError(f'{k} readback does not match requested state ({"react" if react else "deact"})')
+    return results, errors
+
+def react_many(klys_channels, **kw): return set_klys_states({k: True for k in klys_channels}, **kw)
+
+def deact_many(klys_channels, **kw): return set_klys_states({k: False for k in klys_channels}, **kw)
+
 def _set_klys(klys_channel, react=True):
-    ntval = URI_KLYS_SET.wrap(
+    res = CTX.rpc(f'{klys_channel}:TACT', _set_klys_request(klys_channel, react))
+    return res
+
+def _klys_stat_request(klys_channel):
+    return URI_KLYS_TACT.wrap(
+        scheme='pva', path=klys_channel, kws={'TYPE':'SHORT', 'BEAM':'10'}
+        )
+
+def _all_klys_stat_request():
+    return URI_ALL_KLYS.wrap(
+        scheme='pva', path='KLYSTRONGET:TACT', kws={'DEVICES':F2_ALL_KLYS, 'BEAM':'10'}
+        )
+
+def _unpack_all_klys_stat(res):
+    k_status = {}
+    for r in NTT_ALL_KLYS.unwrap(res): k_status[r['name']] = r
+    return k_status
+
+def _klys_stat_array(res):
+    table = res.value
+    stat = np.empty(len(table['name']), dtype=KLYS_STAT_DTYPE)
+    for field in KLYS_STAT_DTYPE.names: stat[field] = table[field]
+    return stat
+
+def _set_klys_request(klys_channel, react=True):
+    return URI_KLYS_SET.wrap(
         scheme='pva', path=f'{klys_channel}:TACT',
         kws={'VALUE':1 if react else 0, 'BEAM':'10'}
         )
-    res = CTX.rpc(f'{klys_channel}:TACT', ntval)
-    return res
+
+# =============================================================================
+# shared status service, one KLYSTRONGET:TACT rpc per period for every subscriber
+
+def _select(rows, klys):
+    """ rows for the klystrons in 'klys', or all of them if it is None """
+    return dict(rows) if klys is None else {k: row for k, row in rows.items() if k in klys}
+
+class KlysStatusService:
+    """
+    polls the status of all klystrons in F2_ALL_KLYS once per 'period' seconds on a background
+    thread and calls subscribers with the rows that changed since the previous poll
+
+    callbacks are called as callback({name: row}) from the polling thread, the first call
+    after subscribing contains the full current table (of the subscribed klystrons)
+
+    Example:
+      token = status_service().subscribe(lambda changed: print(changed), klys=['KLYS:LI11:31'])
+      ...
+      status_service().unsubscribe(token)
+    """
+
+    def __init__(self, period=1.0):
+        self.period = period
+        self.status = {}
+        self._subscribers = {}
+        self._next_token = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._stop.set()
+        self._thread = None
+
+    def subscribe(self, callback, klys=None):
+        """ register 'callback' for all klystrons or only those in 'klys', returns a token for unsubscribe """
+        with self._lock:
+            token = self._next_token
+            self._next_token += 1
+            klys = None if klys is None else frozenset(klys)
+            self._subscribers[token] = (callback, klys)
+            current = _select(self.status, klys)
+            if self._stop.is_set():
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stop,), daemon=True)
+                self._thread.start()
+        if current: self._notify(callback, token, current)
+        return token
+
+    def unsubscribe(self, token):
+        """ remove a subscriber, polling stops when no subscribers remain """
+        with self._lock:
+            self._subscribers.pop(token, None)
+            if not self._subscribers: self._stop.set()
+
+    def get(self, klys_channel):
+        """ latest status row for one klystron (None before the first poll) """
+        with self._lock: return self.status.get(klys_channel)
+
+    def poll(self):
+        """ read the status table once & notify subscribers of changed rows """
+        new_status = get_all_klys_stat()
+        with self._lock:
+            changed = {k: row for k, row in new_status.items() if self.status.get(k) != row}
+            self.status = new_status
+            subscribers = list(self._subscribers.items())
+        if not changed: return
+        for token, (callback, klys) in subscribers:
+            rows = _select(changed, klys)
+            if rows: self._notify(callback, token, rows)
+
+    def _notify(self, callback, token, rows):
+        try:
+            callback(rows)
+        except Exception:
+            print_exc()
+
+    def _run(self, stop):
+        while not stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                print_exc()
+            stop.wait(self.period)
+
+_status_service = None
+_status_service_lock = threading.Lock()
+
+def status_service(period=1.0):
+    """ process-wide KlysStatusService, 'period' only applies when it is first created """
+    global _status_service
+    with _status_service_lock:
+        if _status_service is None: _status_service = KlysStatusService(period)
+        return _status_service
+
+# =============================================================================
+# asyncio versions, i.e. stat = await aget_all_klys_stat()
+
+async def aget_klys_stat(klys_channel, timeout=5.0):
+    res = await arpc(klys_channel, _klys_stat_request(klys_channel), timeout)
+    return res.raw.value
+
+async def aget_all_klys_stat(timeout=5.0):
+    res = await arpc('KLYSTRONGET:TACT', _all_klys_stat_request(), timeout)
+    return _unpack_all_klys_stat(res)
+
+async def aget_all_klys_stat_array(timeout=5.0):
+    res = await arpc('KLYSTRONGET:TACT', _all_klys_stat_request(), timeout)
+    return _klys_stat_array(res)
+
+async def areact(klys_channel, timeout=5.0): return await _aset_klys(klys_channel, timeout=timeout)
+
+async def adeact(klys_channel, timeout=5.0): return await _aset_klys(klys_channel, react=False, timeout=timeout)
+
+async def _aset_klys(klys_channel, react=True, timeout=5.0):
+    return await arpc(f'{klys_channel}:TACT', _set_klys_request(klys_channel, react), timeout)
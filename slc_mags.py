@@ -1,5 +1,16 @@
-from p4p.client.thread import Context
-from p4p.nt import NTURI
+import os
+import json
+import time
+import re
+import atexit
+import random
+import asyncio
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pva_context import LazyContext, arpc
+from p4p.nt import NTURI, NTTable
 
 """
 Written by D. Cesar and modified by C. Zimmer
@@ -7,7 +18,13 @@ Written by D. Cesar and modified by C. Zimmer
 
 magset_typedef = NTURI([('MAGFUNC', 's'), ('LIMITCHECK', 's'), ('VALUE', ('S', 'query', [('names', 'as'), ('values', 'ad')]))])
 db_typedef = NTURI([('TYPE', 's'), ('TABLE_TYPE', 's')])
-ctx = Context("pva")
+ctx = LazyContext('pva')
+
+# default limit on the number of concurrent rpc calls for batched reads/writes
+MAX_INFLIGHT = 16
+
+# SLC micro name field, i.e. LI11 in XCOR:LI11:402
+MICRO_RE = re.compile(r'^LI\d\d$')
 
 def set_magnets(pvs, vals, control='BDES', magfunc='TRIM', limitcheck='SOME', timeout=12, tryagain=True):
     """
@@ -26,16 +43,47 @@ def set_magnets(pvs, vals, control='BDES', magfunc='TRIM', limitcheck='SOME', ti
       If BCON is selected then limitcheck does not apply.
       or "SOME".
     - timeout (flost) [7]: timeout in seconds for the rpc call
-    - tryagain (bool) [True]: if the command timesout, try again with 10 second longer timeout period. If false, do nothing.
+    - tryagain (bool or RetryPolicy) [True]: retry policy for timeouts. True uses DEFAULT_RETRY, False makes a single attempt.
+      Devices on a micro that keeps timing out are skipped (and reported) while its breaker is open, see CircuitBreaker.
+
+    Devices on several micros are sent as one MAGNETSET per micro, concurrently, so a timeout is pinned on
+    (and only costs) the micro that caused it.
 
     Returns:
-    - res: the output of the rpc call.
+    - res: the output of the rpc call, for several micros the result rows (with a 'name' column) of the
+      micros that succeeded, None if nothing was set
 
     Examples:
     - set a magnet:
       set_magnets('YCOR:LI13:303', 0.001)
     - set BDES (without trimming) for many magnets:
       set_magnets(['YCOR:LI13:303', 'YCOR:LI13:403'], [0, 0], magfunc='NOFUNC')
+    """
+    parts = _micro_requests(pvs, vals, control, magfunc, limitcheck)
+    if parts is None: return None
+    labels, names, values, micros, sent = parts
+    if len(labels) > 1:
+        results, errors = _rpc_many(names, values, timeout=timeout, tryagain=tryagain, max_inflight=len(labels),
+            micros=micros, keys=labels)
+        return _magnetset_parts_result(results, errors, sent)
+    name, value, pvs = _magnetset_request(pvs, vals, control, magfunc, limitcheck, breaker=_policy(tryagain).breaker)
+    if name is None: return None
+    # Finally try to submit the command
+    try:
+        res = _rpc(name, value, timeout, tryagain, micros=_micros(pvs))
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return None
+    print('Set SLC magnets! Result:')
+    print(res)
+    return res
+
+
+def _magnetset_request(pvs, vals, control='BDES', magfunc='TRIM', limitcheck='SOME', breaker=None):
+    """
+    build the (rpc name, NTURI value, device names) for a MAGNETSET command, name is None for an unknown control
+    devices on micros that are open in 'breaker' are left out of the request (and the returned names) so the
+    rest of a multi-micro set still goes through, name is None if that leaves nothing to send
     """
      # First cast to list if needed
     if not isinstance(pvs, list):
@@ -43,159 +91,712 @@ def set_magnets(pvs, vals, control='BDES', magfunc='TRIM', limitcheck='SOME', ti
     if not isinstance(vals, list):
         vals = [vals] * len(pvs)  # e.g. if user gives multiple devices but wants them all set to same value
     pvs = check_epics_format(pvs[:])
+    if breaker is not None:
+        pvs, vals = _drop_open_micros(pvs, vals, breaker)
+        if not pvs: return None, None, pvs
     # Now setup command based on desired user type
-    if control == 'BDES':
-        value = magset_typedef.wrap(scheme='pva', path='MAGNETSET:BDES', kws={'MAGFUNC': magfunc, 'LIMITCHECK': limitcheck, 'VALUE': {'names': pvs, 'values': vals}})
-        name = 'MAGNETSET:BDES'
-    elif control == 'VDES':
-        value = magset_typedef.wrap(scheme='pva', path='MAGNETSET:VDES', kws={'MAGFUNC': magfunc, 'LIMITCHECK': limitcheck, 'VALUE': {'names': pvs, 'values': vals}})
-        name = 'MAGNETSET:VDES'
+    if control in ('BDES', 'VDES'):
+        name = f'MAGNETSET:{control}'
+        value = magset_typedef.wrap(scheme='pva', path=name, kws={'MAGFUNC': magfunc, 'LIMITCHECK': limitcheck, 'VALUE': {'names': pvs, 'values': vals}})
     elif control == 'BCON':
-        value = magset_typedef.wrap(scheme='pva', path='MAGNETSET:BCON', kws={'VALUE': {'names': pvs, 'values': vals}})
         name = 'MAGNETSET:BCON'
+        value = magset_typedef.wrap(scheme='pva', path=name, kws={'VALUE': {'names': pvs, 'values': vals}})
     else:
         print("Unknown control. Choose 'BDES', 'VDES', or 'BCON'.")
-    # Finally try to submit the command
-    try:
-        res = ctx.rpc(name, value, timeout=timeout)
-    except TimeoutError as e:
+        return None, None, pvs
+    return name, value, pvs
+
+
+def _drop_open_micros(pvs, vals, breaker):
+    """ remove devices on micros with an open circuit breaker, the dropped devices are reported """
+    open_micros = breaker.open_micros(_micros(pvs))
+    if not open_micros: return pvs, vals
+    keep = [not (_micros([pv]) & open_micros) for pv in pvs]
+    dropped = [pv for pv, k in zip(pvs, keep) if not k]
+    print(f'circuit open for {", ".join(sorted(open_micros))}, not setting {len(dropped)} devices: {dropped}')
+    return [pv for pv, k in zip(pvs, keep) if k], [v for v, k in zip(vals, keep) if k]
+
+
+# substrings of the per-device MAGNETSET 'state' that mean the device was not set (case insensitive)
+MAGNETSET_BAD_STATES = ('FAIL', 'ERR', 'LIMIT', 'TIMEOUT', 'BAD', 'REJECT')
+
+def parse_magnetset_result(res, names=None):
+    """
+    split a MAGNETSET result table into per-device states
+    the table has one row per device in request order (status, bact_or_vact) without device names,
+    so rows are matched to 'names' (the devices that were sent) by position, a 'name' column is only
+    used for rows beyond 'names' (i.e. rows from set_magnets_by_micro, which adds it)
+
+    Returns:
+    - states: dict of {device: state string} for every row of the table
+    - failed: list of devices whose state indicates a failed or limit-rejected set
+    """
+    rows = res if isinstance(res, list) else NTTable.unwrap(res)
+    names = names or []
+    states, failed = {}, []
+    for i, r in enumerate(rows):
+        device = names[i] if i < len(names) else r.get('name', i)
+        state = str(r.get('state', r.get('status', '')))
+        states[device] = state
+        if any(bad in state.upper() for bad in MAGNETSET_BAD_STATES): failed.append(device)
+    return states, failed
+
+
+def set_magnets_checked(pvs, vals, control='BDES', magfunc='TRIM', limitcheck='SOME', timeout=12, rounds=2,
+    tol=1e-4, rtol=1e-3):
+    """
+    like set_magnets, but only devices that failed are re-sent on the next round instead of the whole list
+    If a round times out (so there is no result table) the devices whose readback already matches the
+    request are treated as done and only the rest are re-sent. For TRIM/PTRB the readback is BACT/VACT,
+    since BDES/VDES is written before the trim runs, otherwise it is the control value itself.
+
+    Args: same as set_magnets, plus
+    - rounds (int) [2]: max number of MAGNETSET calls
+    - tol, rtol (float) [1e-4, 1e-3]: absolute & relative tolerance used to decide a device was set after a timeout
+
+    Returns:
+    - states: dict of {device: state string} from the last round each device was sent in
+    - failed: list of devices that were not set after all rounds
+
+    Examples:
+    - load a config, resending only the magnets that didn't make it:
+      states, failed = set_magnets_checked(devices, bdes)
+    """
+    if not isinstance(pvs, list):
+        pvs = [pvs]
+    if not isinstance(vals, list):
+        vals = [vals] * len(pvs)
+    targets = dict(zip(check_epics_format(pvs[:]), vals))
+    pending = list(targets)
+    states = {}
+    for n in range(rounds):
+        if not pending: break
+        name, value, sent = _magnetset_request(pending, [targets[d] for d in pending], control, magfunc, limitcheck,
+            breaker=NO_RETRY.breaker)
+        states.update({d: 'CIRCUIT_OPEN' for d in pending if d not in sent})
+        if name is None: return states, pending
         try:
-            print('Command timed out')
-            if tryagain:
-                print('Trying one more time')
-                res = ctx.rpc(name, value, timeout=timeout+10)
-            else:
-                print(f"An error occurred: {e}")
-                return None
+            res = _rpc(name, value, timeout, NO_RETRY, micros=_micros(pending))
+        except (TimeoutError, asyncio.TimeoutError):
+            attr = _readback_attr(control, magfunc)
+            print(f'MAGNETSET timed out, checking {attr} for {len(pending)} devices')
+            pending = _unset_devices(pending, targets, attr, tol, rtol)
+            states.update({d: 'TIMEOUT' for d in pending})
+            continue
         except Exception as e:
             print(f"An error occurred: {e}")
-            return None
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return None
+            return states, pending
+        unsent = [d for d in pending if d not in sent]
+        round_states, pending = parse_magnetset_result(res, sent)
+        states.update(round_states)
+        # devices missing from the table are unaccounted for, send them again
+        pending += [d for d in sent if d not in round_states] + unsent
+        if pending: print(f'{len(pending)} devices failed, retrying those only')
+    return states, pending
+
+
+def _readback_attr(control, magfunc):
+    """ attribute showing whether a MAGNETSET took effect, the actual value for trims & perturbs """
+    if magfunc in ('TRIM', 'PTRB'): return {'BDES': 'BACT', 'VDES': 'VACT'}.get(control, control)
+    return control
+
+def _unset_devices(devices, targets, attr, tol, rtol):
+    """ devices whose 'attr' readback does not match the target value (or could not be read) """
+    readback, _ = get_aidapva_many([f'{d}:{attr}' for d in devices])
+    return [d for d, rb in zip(devices, readback) if rb is None or abs(rb - targets[d]) > tol + rtol*abs(targets[d])]
+
+
+def set_magnets_by_micro(pvs, vals, control='BDES', magfunc='TRIM', limitcheck='SOME', timeout=12, tryagain=True,
+    chunk_size=None, max_inflight=10):
+    """
+    like set_magnets, but the device list is split by SLC micro (and optionally into chunks of at most 'chunk_size'
+    devices) and each part is sent as its own MAGNETSET call, concurrently, so the whole set takes about as long
+    as the slowest micro & a stuck micro only fails its own devices
+
+    Args: same as set_magnets, plus
+    - chunk_size (int) [None]: max devices per MAGNETSET call, default is one call per micro
+    - max_inflight (int) [10]: max number of concurrent MAGNETSET calls
+
+    Returns:
+    - rows: list of MAGNETSET result table rows, with a 'name' column added, for all parts that succeeded
+    - errors: dict of {part label: exception} for parts that failed, i.e. {'LI14': TimeoutError(...)}
+
+    Examples:
+    - reload a lattice across LI11-LI20:
+      rows, errors = set_magnets_by_micro(devices, bdes)
+      states, failed = parse_magnetset_result(rows)
+    """
+    parts = _micro_requests(pvs, vals, control, magfunc, limitcheck, chunk_size)
+    if parts is None: return [], {}
+    labels, names, values, micros, sent = parts
+    results, errors = _rpc_many(names, values, timeout=timeout, tryagain=tryagain, max_inflight=max_inflight, micros=micros, keys=labels)
+    rows = _magnetset_rows(results, sent)
+    for label, e in errors.items(): print(f'MAGNETSET failed for {label}: {e}')
+    return rows, errors
+
+
+def _micro_requests(pvs, vals, control, magfunc, limitcheck, chunk_size=None):
+    """
+    split a MAGNETSET by SLC micro (and into chunks of at most 'chunk_size' devices), returns lists of
+    (labels, rpc names, NTURI values, micros, device names) with one entry per part, None for an unknown control
+    """
+    if not isinstance(pvs, list):
+        pvs = [pvs]
+    if not isinstance(vals, list):
+        vals = [vals] * len(pvs)
+    groups = OrderedDict()
+    for pv, val in zip(check_epics_format(pvs[:]), vals):
+        micro = min(_micros([pv]), default='')
+        groups.setdefault(micro, []).append((pv, val))
+
+    labels, names, values, micros, sent = [], [], [], [], []
+    for micro, devs in groups.items():
+        size = chunk_size or len(devs)
+        n_chunks = -(-len(devs) // size)
+        for i in range(0, len(devs), size):
+            chunk = devs[i:i+size]
+            name, value, chunk_pvs = _magnetset_request([d for d, _ in chunk], [v for _, v in chunk], control, magfunc, limitcheck)
+            if name is None: return None
+            labels.append(micro if n_chunks == 1 else f'{micro}#{i//size}')
+            names.append(name)
+            values.append(value)
+            micros.append(_micros(chunk_pvs))
+            sent.append(chunk_pvs)
+    return labels, names, values, micros, sent
+
+
+def _magnetset_rows(results, sent):
+    """ result rows of the parts that succeeded, labelled with their device names for parse_magnetset_result """
+    rows = []
+    for res, chunk_pvs in zip(results, sent):
+        if res is None: continue
+        # the reply rows are in request order without device names
+        rows += [dict(r, name=pv) for pv, r in zip(chunk_pvs, res if isinstance(res, list) else NTTable.unwrap(res))]
+    return rows
+
+
+def _magnetset_parts_result(results, errors, sent):
+    """ set_magnets result for a per-micro MAGNETSET, failed micros are reported """
+    for label, e in errors.items(): print(f'MAGNETSET failed for {label}: {e}')
+    if len(errors) == len(sent): return None
+    rows = _magnetset_rows(results, sent)
     print('Set SLC magnets! Result:')
-    print(res)
-    return res
+    print(rows)
+    return rows
+
 
+# default cache lifetimes in seconds for SLC database attributes, 0 means never cache
+# attributes not listed here are not cached
+DEFAULT_TTL_RULES = {
+    'LEFF': 24*3600,
+    'POLY': 24*3600,
+    'IMMS': 24*3600,
+    'BACT': 0,
+    'BDES': 0,
+    'BCON': 0,
+    'VACT': 0,
+    'VDES': 0,
+    }
 
-def get_aidapva(pvs, return_types='DOUBLE', timeout=1, tryagain=True):
+
+class AidaCache:
+    """
+    LRU cache for SLC database values with per-attribute lifetimes & an optional json backing file
+    the attribute is the last field of the pv name, i.e. LEFF for 'YCOR:LI13:303:LEFF'
     """
-     Used to access SLC "database" values. Like regular pvs. AFAIK the rpcs commands are one at a time, so the looping is for user convenience only.
+
+    def __init__(self, ttl_rules=None, maxsize=4096, path=None):
+        self.ttl_rules = dict(DEFAULT_TTL_RULES if ttl_rules is None else ttl_rules)
+        self.maxsize = maxsize
+        self.path = path
+        self._entries = OrderedDict() # (pv, return_type) -> (fetch time, value)
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path): self.load()
+
+    def ttl(self, pv):
+        return self.ttl_rules.get(pv.split(':')[-1], 0)
+
+    def get(self, pv, return_type):
+        """ returns (True, value) for a valid entry, (False, None) otherwise """
+        key = (pv, return_type)
+        with self._lock:
+            if key not in self._entries: return False, None
+            t_fetch, value = self._entries[key]
+            if time.time() - t_fetch > self.ttl(pv):
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def put(self, pv, return_type, value):
+        if self.ttl(pv) <= 0: return
+        with self._lock:
+            self._entries[(pv, return_type)] = (time.time(), value)
+            self._entries.move_to_end((pv, return_type))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, pv):
+        """ drop all entries for 'pv' (any return type) """
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == pv]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock: self._entries.clear()
+
+    def load(self):
+        with open(self.path, 'r') as f: entries = json.load(f)
+        with self._lock:
+            for pv, return_type, t_fetch, value in entries:
+                self._entries[(pv, return_type)] = (t_fetch, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """ write entries to the backing file, values that aren't plain json types are skipped """
+        if self.path is None: return
+        with self._lock:
+            entries = [[pv, rt, t, v] for (pv, rt), (t, v) in self._entries.items()
+                if isinstance(v, (bool, int, float, str, list))]
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f: json.dump(entries, f)
+        os.replace(tmp, self.path)
+
+
+# module cache used by get_aidapva when enabled, off by default
+_cache = None
+
+def enable_cache(ttl_rules=None, maxsize=4096, path=None):
+    """
+    turn on caching of get_aidapva reads
+    Args:
+    - ttl_rules (dict) [DEFAULT_TTL_RULES]: {attribute: lifetime in seconds}, unlisted attributes are not cached
+    - maxsize (int) [4096]: max number of entries, least recently used entries are dropped first
+    - path (str) [None]: optional json file to load the cache from & save it to at exit
+
+    Examples:
+    - cache lengths for a day across sessions:
+      enable_cache({'LEFF': 86400}, path='/tmp/slc_db_cache.json')
+    """
+    global _cache
+    disable_cache()
+    _cache = AidaCache(ttl_rules=ttl_rules, maxsize=maxsize, path=path)
+    return _cache
+
+def disable_cache():
+    global _cache
+    if _cache is not None: _cache.save()
+    _cache = None
+
+# one saver for whichever cache is enabled at exit, so a replaced/disabled cache never overwrites the file
+atexit.register(lambda: _cache is not None and _cache.save())
+
+def _cache_lookup(pvs, return_types):
+    """ returns a result list filled in from the cache & the indices of values that still need an rpc """
+    results = [None] * len(pvs)
+    i_fetch = []
+    for i, (pv, return_type) in enumerate(zip(pvs, return_types)):
+        hit, val = _cache.get(pv, return_type) if _cache is not None else (False, None)
+        if hit: results[i] = val
+        else: i_fetch.append(i)
+    return results, i_fetch
+
+def _cache_store(pvs, return_types, results, i_fetch, fetched, errors):
+    """ merge fetched values into 'results' & cache the successful ones """
+    for i, res in zip(i_fetch, fetched):
+        results[i] = res
+        if _cache is not None and pvs[i] not in errors: _cache.put(pvs[i], return_types[i], res)
+
+
+class CircuitOpenError(RuntimeError):
+    """ raised without sending an rpc when a micro's circuit breaker is open """
+
+
+class CircuitBreaker:
+    """
+    per-micro circuit breaker: after 'fail_threshold' consecutive failed calls to a micro, calls to it
+    fail immediately for 'reset_after' seconds, then a single trial call is let through
+    """
+
+    def __init__(self, fail_threshold=3, reset_after=30.0):
+        self.fail_threshold = fail_threshold
+        self.reset_after = reset_after
+        self._fails = {}     # micro -> consecutive failures
+        self._opened = {}    # micro -> time the breaker opened
+        self._lock = threading.Lock()
+
+    def open_micros(self, micros):
+        """ the subset of 'micros' that are open (excluding those due for a trial call) """
+        now = time.monotonic()
+        with self._lock:
+            return {m for m in micros if m in self._opened and now - self._opened[m] < self.reset_after}
+
+    def check(self, micros):
+        """ raise CircuitOpenError if any of 'micros' is open """
+        now = time.monotonic()
+        with self._lock:
+            blocked = []
+            for m in micros:
+                if m not in self._opened: continue
+                if now - self._opened[m] < self.reset_after: blocked.append(m)
+                else: self._opened[m] = now # half open, let this call through & hold off others
+            if blocked: raise CircuitOpenError(f'circuit open for {", ".join(sorted(blocked))}')
+
+    def success(self, micros):
+        with self._lock:
+            for m in micros:
+                self._fails.pop(m, None)
+                self._opened.pop(m, None)
+
+    def failure(self, micros):
+        with self._lock:
+            for m in micros:
+                self._fails[m] = self._fails.get(m, 0) + 1
+                if self._fails[m] >= self.fail_threshold: self._opened[m] = time.monotonic()
+
+    def reset(self):
+        with self._lock:
+            self._fails.clear()
+            self._opened.clear()
+
+
+class RetryPolicy:
+    """
+    retry failed rpc calls with exponential backoff & jitter within an overall deadline
+    Args:
+    - deadline (float) [None]: total time budget in seconds for all attempts, default is 2.5*timeout
+    - max_attempts (int) [3]: max number of attempts
+    - backoff (float) [0.25]: delay before the first retry, doubled for every retry after that
+    - backoff_max (float) [4.0]: max delay between attempts
+    - jitter (float) [0.5]: delays are randomized by up to this fraction
+    - timeout_growth (float) [2.0]: the per-attempt timeout is multiplied by this after each attempt
+    - retry_on (tuple) [timeouts]: exception types that are retried, anything else fails immediately
+    - breaker (CircuitBreaker) [None]: per-micro circuit breaker, the module policies use the shared BREAKER
+    """
+
+    def __init__(self, deadline=None, max_attempts=3, backoff=0.25, backoff_max=4.0, jitter=0.5,
+        timeout_growth=2.0, retry_on=(TimeoutError, asyncio.TimeoutError), breaker=None):
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.timeout_growth = timeout_growth
+        self.retry_on = retry_on
+        self.breaker = breaker
+
+    def _delay(self, n):
+        d = min(self.backoff * 2**n, self.backoff_max)
+        return d * (1 + self.jitter * (2*random.random() - 1))
+
+    def _attempts(self, timeout):
+        """ yields per-attempt timeouts, and the backoff delay to wait before each of them """
+        t_end = time.monotonic() + (2.5*timeout if self.deadline is None else self.deadline)
+        for n in range(self.max_attempts):
+            delay = 0 if n == 0 else self._delay(n-1)
+            remaining = t_end - time.monotonic() - delay
+            if remaining <= 0: return
+            yield delay, min(timeout * self.timeout_growth**n, remaining)
+
+    def call(self, attempt, timeout, micros=()):
+        """
+        call attempt(timeout) until it succeeds or the budget runs out, only errors in 'retry_on' count as
+        micro failures for the breaker (i.e. a bad device name says nothing about the micro)
+        """
+        if self.breaker is not None: self.breaker.check(micros)
+        err = TimeoutError('retry deadline exceeded')
+        for delay, t in self._attempts(timeout):
+            if delay: time.sleep(delay)
+            try:
+                res = attempt(t)
+            except self.retry_on as e:
+                err = e
+                continue
+            self._done(micros, ok=True)
+            return res
+        self._done(micros, ok=False)
+        raise err
+
+    async def acall(self, attempt, timeout, micros=()):
+        """ asyncio version of call, 'attempt' returns an awaitable """
+        if self.breaker is not None: self.breaker.check(micros)
+        err = TimeoutError('retry deadline exceeded')
+        for delay, t in self._attempts(timeout):
+            if delay: await asyncio.sleep(delay)
+            try:
+                res = await attempt(t)
+            except self.retry_on as e:
+                err = e
+                continue
+            self._done(micros, ok=True)
+            return res
+        self._done(micros, ok=False)
+        raise err
+
+    def _done(self, micros, ok):
+        if self.breaker is None: return
+        if ok: self.breaker.success(micros)
+        # a multi-micro request failing doesn't say which micro is at fault
+        elif len(micros) == 1: self.breaker.failure(micros)
+
+
+# shared breaker, default retry policy & single-attempt policy used by all calls in this module
+BREAKER = CircuitBreaker()
+DEFAULT_RETRY = RetryPolicy(breaker=BREAKER)
+NO_RETRY = RetryPolicy(max_attempts=1, deadline=float('inf'), breaker=BREAKER)
+
+def _policy(tryagain):
+    """ 'tryagain' may be a bool (for backwards compatibility) or a RetryPolicy """
+    if isinstance(tryagain, RetryPolicy): return tryagain
+    return DEFAULT_RETRY if tryagain else NO_RETRY
+
+def _micros(names):
+    """ set of SLC micros (i.e. LI11) referenced by a list of device/pv names """
+    return {f for name in names for f in name.split(':')[:2] if MICRO_RE.match(f)}
+
+
+def _rpc(name, value, timeout, tryagain, micros=None):
+    """ single rpc call, timeouts are retried according to the policy given by 'tryagain' """
+    if micros is None: micros = _micros([name])
+    return _policy(tryagain).call(lambda t: ctx.rpc(name, value, timeout=t), timeout, micros)
+
+
+def _rpc_many(names, values, timeout=1, tryagain=True, max_inflight=MAX_INFLIGHT, micros=None, keys=None):
+    """
+    submit rpc calls concurrently on the shared context, at most 'max_inflight' at a time
+    returns a list of results in the same order as 'names' & a dict of {name: exception} for failed calls
+    (failed calls have a result of None)
+    'micros' optionally gives the micros for each call (for the circuit breaker) & 'keys' the error dict keys
+    """
+    results = [None] * len(names)
+    errors = {}
+    if not names: return results, errors
+    if micros is None: micros = [None] * len(names)
+    if keys is None: keys = names
+    n_workers = max(1, min(max_inflight, len(names)))
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(_rpc, n, v, timeout, tryagain, m) for n, v, m in zip(names, values, micros)]
+        for i, (key, f) in enumerate(zip(keys, futures)):
+            try:
+                results[i] = f.result()
+            except Exception as e:
+                errors[key] = e
+    return results, errors
+
+
+def get_aidapva(pvs, return_types='DOUBLE', timeout=1, tryagain=True, max_inflight=MAX_INFLIGHT):
+    """
+     Used to access SLC "database" values. Like regular pvs. Each value is a separate rpc, these are sent concurrently
+     (up to 'max_inflight' at a time) so reading many values takes roughly one round-trip.
       https://www.slac.stanford.edu/grp/cd/soft/aida/aida-pva/md_docs_1_02__users__guide__s_l_c__controls__database__channel__provider.html
         Args:
         - pvs (list of strings or string): pv names for the magnets
         - return_types (list of str or str): values to be set corresponding to the pvs.
         - timeout (flost) [1]: timeout in seconds for the rpc call
-        - tryagain (bool) [True]: if the command timesout, try again with 5 second longer timeout period. If false, do nothing.
+        - tryagain (bool or RetryPolicy) [True]: retry policy for timeouts. True uses DEFAULT_RETRY, False makes a single attempt.
+        - max_inflight (int) [16]: maximum number of concurrent rpc calls
 
         Returns:
-        - res: a list of values from the rpc calls
+        - res: a list of values from the rpc calls, or None if any of them failed (see get_aidapva_many for per-PV errors)
 
         Examples:
         - Read a bact:
           get_aidapva('YCOR:LI13:303:BACT')
         - Read some magnet lengths
           get_aidapva(['YCOR:LI13:303:LEFF','YCOR:LI13:203:LEFF'])
+    """
+    returnscalar = not isinstance(pvs, list)
+    results, errors = get_aidapva_many(pvs, return_types, timeout=timeout, tryagain=tryagain, max_inflight=max_inflight)
+    if errors:
+        for pv, e in errors.items(): print(f"An error occurred for {pv}: {e}")
+        return None
+    if returnscalar:
+        results = results[0] #match input format
+    return results
+
+
+def get_aidapva_many(pvs, return_types='DOUBLE', timeout=1, tryagain=True, max_inflight=MAX_INFLIGHT):
+    """
+     batched version of get_aidapva that does not give up on the first failure
+        Returns:
+        - results: list of values in the same order as 'pvs', None for PVs that failed
+        - errors: dict of {pv: exception} for the PVs that failed
+
+        Examples:
+        - Read BACTs for a sector, report failures:
+          vals, errs = get_aidapva_many([f'{m}:BACT' for m in mags])
     """
      # First cast to list if needed
-    returnscalar = False
     if not isinstance(pvs, list):
         pvs = [pvs]
-        returnscalar = True
     if not isinstance(return_types, list):
         return_types = [return_types]*len(pvs)
-    results = []
     pvs = check_epics_format(pvs[:])
-    for pv, return_type in zip(pvs, return_types):
-        value = db_typedef.wrap(scheme='pva', path=pv, kws={'TYPE': return_type})
-        try:
-            res = ctx.rpc(pv, value, timeout=timeout)
-        except TimeoutError as e:
-            try:
-                print('Command timed out')
-                if tryagain:
-                    print('Trying one more time')
-                    res = ctx.rpc(pv,value,timeout=timeout+5)
-                else:
-                    print(f"An error occurred: {e}")
-                    return None
-            except Exception as e:
-                print(f"An error occurred: {e}")
-                return None
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            return None
-        results.append(res)
-        if returnscalar:
-            results = results[0] #match input format
-    return results
+    results, i_fetch = _cache_lookup(pvs, return_types)
+    values = [db_typedef.wrap(scheme='pva', path=pvs[i], kws={'TYPE': return_types[i]}) for i in i_fetch]
+    fetched, errors = _rpc_many([pvs[i] for i in i_fetch], values, timeout=timeout, tryagain=tryagain, max_inflight=max_inflight)
+    _cache_store(pvs, return_types, results, i_fetch, fetched, errors)
+    return results, errors
 
 
-def set_aidapva(pvs,vals,value_types='FLOAT_ARRAY',timeout=1,tryagain=True):
+def set_aidapva(pvs,vals,value_types='FLOAT_ARRAY',timeout=1,tryagain=True,max_inflight=MAX_INFLIGHT):
     """
-     Used to set SLC scalar "database" values. Like regular pvs. AFAIK the rpcs commands are one at a time, so the looping is for user convience only.
+     Used to set SLC scalar "database" values. Like regular pvs. Each value is a separate rpc, these are sent
+     concurrently (up to 'max_inflight' at a time).
       https://www.slac.stanford.edu/grp/cd/soft/aida/aida-pva/md_docs_1_02__users__guide__s_l_c__controls__database__channel__provider.html
         Args:
         - pvs (list of strings or string): pv names for the magnets
         - vals (val or list of vals): values to set the pvs. Each 'val' of the list may be int/float or array ofint/float and must correspond to one the data type below (which may be arrays themselves if the pv holds an array)
         - value_types (list of str or str): FLOAT_ARRAY or INTEGER_ARRAY
         - timeout (flost) [1]: timeout in seconds for the rpc call
-        - tryagain (bool) [True]: if the command timesout, try again with 5 second longer timeout period. If false, do nothing.
+        - tryagain (bool or RetryPolicy) [True]: retry policy for timeouts. True uses DEFAULT_RETRY, False makes a single attempt.
+        - max_inflight (int) [16]: maximum number of concurrent rpc calls
 
         Returns:
-        - none
+        - the result of the last rpc call, or None if any of them failed (see set_aidapva_many for per-PV errors)
 
         Examples:
         - set a bcon:
           set_aidapva('YCOR:LI13:303:BCON',0.001)
 
     """
+    if value_types not in ('FLOAT_ARRAY', 'INTEGER_ARRAY'):
+        print('Unknown value type, try FLOAT_ARRAY or INTEGER_ARRAY')
+        return
+    results, errors = set_aidapva_many(pvs, vals, value_types, timeout=timeout, tryagain=tryagain, max_inflight=max_inflight)
+    if errors:
+        for pv, e in errors.items(): print(f"An error occurred for {pv}: {e}")
+        return None
+    return results[-1] if results else None
+
+
+def set_aidapva_many(pvs, vals, value_types='FLOAT_ARRAY', timeout=1, tryagain=True, max_inflight=MAX_INFLIGHT):
+    """
+     batched version of set_aidapva that does not give up on the first failure
+        Returns:
+        - results: list of rpc results in the same order as 'pvs', None for PVs that failed
+        - errors: dict of {pv: exception} for the PVs that failed
+    """
+    pvs, values = _aidapva_set_requests(pvs, vals, value_types)
+    return _rpc_many(pvs, values, timeout=timeout, tryagain=tryagain, max_inflight=max_inflight)
+
+
+def _aidapva_set_requests(pvs, vals, value_types):
+    """ build the list of pv names & NTURI values for set_aidapva """
     #setup typedef for pva
     if value_types == 'FLOAT_ARRAY':
-        db_typedef=NTURI([('VALUE','af'),('VALUE_TYPE','s')])
+        set_typedef=NTURI([('VALUE','af'),('VALUE_TYPE','s')])
     elif value_types == 'INTEGER_ARRAY':
-        db_typedef=NTURI([('VALUE','ai'),('VALUE_TYPE','s')])
+        set_typedef=NTURI([('VALUE','ai'),('VALUE_TYPE','s')])
     else:
-        print('Unknown value type, try FLOAT_ARRAY or INTEGER_ARRAY')
-        return
+        raise ValueError('Unknown value type, try FLOAT_ARRAY or INTEGER_ARRAY')
 
      # Cast to list if needed
     if not isinstance(pvs, list):
         pvs = [pvs]
     if not isinstance(vals, list):
         vals = [vals]*len(pvs)
-    if not isinstance(value_types, list):
-        value_types = [value_types]*len(pvs)
 
-    for pv, val, value_type in zip(pvs,vals,value_types):
+    values = []
+    for pv, val in zip(pvs,vals):
         if not isinstance(val, list):
             val = [val] # again make a list, since our typedef is expecting a list (and though some pvs are scalars, some are natively lists, so this if loop won't execute)
-        value = db_typedef.wrap(scheme='pva', path=pv, kws={'VALUE':val,'VALUE_TYPE': value_type})
-        try:
-            res = ctx.rpc(pv, value, timeout=timeout)
-        except TimeoutError as e:
-            try:
-                print('Command timed out')
-                if tryagain:
-                    print('Trying one more time')
-                    res = ctx.rpc(pv,value,timeout=timeout+5)
-                else:
-                    print(f"An error occurred: {e}")
-                    return None
-            except Exception as e:
-                print(f"An error occurred: {e}")
-                return None
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            return None
+        values.append(set_typedef.wrap(scheme='pva', path=pv, kws={'VALUE':val,'VALUE_TYPE': value_types}))
+        if _cache is not None: _cache.invalidate(_epics_name(pv))
+    return pvs, values
+
+
+# =============================================================================
+# asyncio versions of the above, these share request building & caching with the threaded API
+# but run on a p4p asyncio Context so many calls can be awaited together
+
+async def _arpc(name, value, timeout, tryagain, micros=None):
+    if micros is None: micros = _micros([name])
+    return await _policy(tryagain).acall(lambda t: arpc(name, value, t), timeout, micros)
+
+async def _arpc_many(names, values, timeout=1, tryagain=True, max_inflight=MAX_INFLIGHT, micros=None, keys=None):
+    """ asyncio version of _rpc_many, same arguments & (results, errors) return format """
+    if micros is None: micros = [None] * len(names)
+    if keys is None: keys = names
+    sem = asyncio.Semaphore(max(1, max_inflight))
+    async def limited(name, value, m):
+        async with sem: return await _arpc(name, value, timeout, tryagain, micros=m)
+    out = await asyncio.gather(*[limited(n, v, m) for n, v, m in zip(names, values, micros)], return_exceptions=True)
+    results, errors = [None] * len(names), {}
+    for i, (key, res) in enumerate(zip(keys, out)):
+        if isinstance(res, Exception): errors[key] = res
+        else: results[i] = res
+    return results, errors
+
+async def aset_magnets(pvs, vals, control='BDES', magfunc='TRIM', limitcheck='SOME', timeout=12, tryagain=True):
+    """ asyncio version of set_magnets, i.e. res = await aset_magnets('YCOR:LI13:303', 0.001) """
+    parts = _micro_requests(pvs, vals, control, magfunc, limitcheck)
+    if parts is None: return None
+    labels, names, values, micros, sent = parts
+    if len(labels) > 1:
+        results, errors = await _arpc_many(names, values, timeout=timeout, tryagain=tryagain, max_inflight=len(labels),
+            micros=micros, keys=labels)
+        return _magnetset_parts_result(results, errors, sent)
+    name, value, pvs = _magnetset_request(pvs, vals, control, magfunc, limitcheck, breaker=_policy(tryagain).breaker)
+    if name is None: return None
+    try:
+        res = await _arpc(name, value, timeout, tryagain, micros=_micros(pvs))
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return None
+    print('Set SLC magnets! Result:')
+    print(res)
     return res
 
+async def aget_aidapva_many(pvs, return_types='DOUBLE', timeout=1, tryagain=True, max_inflight=MAX_INFLIGHT):
+    """ asyncio version of get_aidapva_many """
+    if not isinstance(pvs, list):
+        pvs = [pvs]
+    if not isinstance(return_types, list):
+        return_types = [return_types]*len(pvs)
+    pvs = check_epics_format(pvs[:])
+    results, i_fetch = _cache_lookup(pvs, return_types)
+    values = [db_typedef.wrap(scheme='pva', path=pvs[i], kws={'TYPE': return_types[i]}) for i in i_fetch]
+    fetched, errors = await _arpc_many([pvs[i] for i in i_fetch], values, timeout=timeout, tryagain=tryagain, max_inflight=max_inflight)
+    _cache_store(pvs, return_types, results, i_fetch, fetched, errors)
+    return results, errors
+
+async def aget_aidapva(pvs, return_types='DOUBLE', timeout=1, tryagain=True, max_inflight=MAX_INFLIGHT):
+    """ asyncio version of get_aidapva """
+    returnscalar = not isinstance(pvs, list)
+    results, errors = await aget_aidapva_many(pvs, return_types, timeout=timeout, tryagain=tryagain, max_inflight=max_inflight)
+    if errors:
+        for pv, e in errors.items(): print(f"An error occurred for {pv}: {e}")
+        return None
+    return results[0] if returnscalar else results
+
+async def aset_aidapva_many(pvs, vals, value_types='FLOAT_ARRAY', timeout=1, tryagain=True, max_inflight=MAX_INFLIGHT):
+    """ asyncio version of set_aidapva_many """
+    pvs, values = _aidapva_set_requests(pvs, vals, value_types)
+    return await _arpc_many(pvs, values, timeout=timeout, tryagain=tryagain, max_inflight=max_inflight)
+
+async def aset_aidapva(pvs, vals, value_types='FLOAT_ARRAY', timeout=1, tryagain=True, max_inflight=MAX_INFLIGHT):
+    """ asyncio version of set_aidapva """
+    if value_types not in ('FLOAT_ARRAY', 'INTEGER_ARRAY'):
+        print('Unknown value type, try FLOAT_ARRAY or INTEGER_ARRAY')
+        return
+    results, errors = await aset_aidapva_many(pvs, vals, value_types, timeout=timeout, tryagain=tryagain, max_inflight=max_inflight)
+    if errors:
+        for pv, e in errors.items(): print(f"An error occurred for {pv}: {e}")
+        return None
+    return results[-1] if results else None
+
 
 def check_epics_format(pvs):
     """Simple function to make sure magnets are in epics form, i.e. XCOR:LI14:402 and not LI14:XCOR:402"""
     for i, pv in enumerate(pvs):
-        if pv[:2] in ["LI", "IN"]:
-            spl_pv = pv.split(":")
-            new_pv = f'{spl_pv[1]}:{spl_pv[0]}:{spl_pv[2]}'
-            pvs[i] = new_pv
-    return pvs
\ No newline at end of file
+        pvs[i] = _epics_name(pv)
+    return pvs
+
+@lru_cache(maxsize=65536)
+def _epics_name(pv):
+    """ epics form of a single name, any attribute field after the unit number is kept """
+    if pv[:2] not in ["LI", "IN"]: return pv
+    spl_pv = pv.split(":")
+    return ':'.join([spl_pv[1], spl_pv[0]] + spl_pv[2:])
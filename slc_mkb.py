@@ -1,13 +1,120 @@
-from p4p.client.thread import Context
+import threading
+from traceback import print_exc
+from pva_context import LazyContext, arpc
 from p4p.nt import NTURI, NTTable
 
-CTX = Context('pva')
+CTX = LazyContext('pva')
 MKB_ADDR = 'MKB:VAL'
 URI_MKB_SET = NTURI([('VALUE','s'), ('MKB','s')])
 
 def set_mkb(name, delta):
     """ adjust an SLC multiknob by the value delta """
-    ntval = URI_MKB_SET.wrap(
+    return CTX.rpc(MKB_ADDR, _mkb_request(name, delta))
+
+def _mkb_request(name, delta):
+    return URI_MKB_SET.wrap(
         scheme='pva', path=MKB_ADDR, kws={'VALUE':delta, 'MKB':name}
         )
-    return CTX.rpc(MKB_ADDR, ntval)
+
+class MKBDispatcher:
+    """
+    non-blocking multiknob writer, deltas submitted while an MKB rpc is in flight are
+    summed & sent as the next request so the knob ends up at the intended total
+
+    'committed' is the displacement written so far, 'pending' the displacement
+    that is queued or in flight, a failed rpc's delta is dropped (never added to 'committed')
+    & reported to the on_error callbacks, callbacks are called from the writer thread as
+    on_commit(delta) / on_error(delta, exception)
+
+    Example:
+      knob = mkb_dispatcher('l2_phase', on_error=lambda delta, e: print(delta, e))
+      knob.submit(0.5)
+    """
+
+    def __init__(self, name, on_commit=None, on_error=None):
+        self.name = name
+        self._on_commit = []
+        self._on_error = []
+        self.committed = 0.0
+        self._queued = 0.0
+        self._in_flight = 0.0
+        self._lock = threading.Lock()
+        self._worker = None
+        self.attach(on_commit, on_error)
+
+    @property
+    def pending(self):
+        with self._lock: return self._queued + self._in_flight
+
+    @property
+    def total(self):
+        """ committed + pending, the displacement the knob ends up at if every queued delta succeeds """
+        with self._lock: return self.committed + self._queued + self._in_flight
+
+    @property
+    def busy(self):
+        with self._lock: return self._worker is not None
+
+    def attach(self, on_commit=None, on_error=None):
+        """ add commit/error callbacks, i.e. from each widget that shares this knob """
+        with self._lock:
+            if on_commit is not None: self._on_commit.append(on_commit)
+            if on_error is not None: self._on_error.append(on_error)
+
+    def detach(self, on_commit=None, on_error=None):
+        with self._lock:
+            if on_commit in self._on_commit: self._on_commit.remove(on_commit)
+            if on_error in self._on_error: self._on_error.remove(on_error)
+
+    def submit(self, delta):
+        """ queue 'delta', starts a background writer if none is running """
+        with self._lock:
+            self._queued += delta
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._queued == 0.0:
+                    self._worker = None
+                    return
+                delta, self._queued = self._queued, 0.0
+                self._in_flight = delta
+            try:
+                set_mkb(self.name, delta)
+            except Exception as e:
+                print_exc()
+                with self._lock:
+                    self._in_flight = 0.0
+                    callbacks = list(self._on_error)
+                self._notify(callbacks, delta, e)
+                continue
+            with self._lock:
+                self.committed += delta
+                self._in_flight = 0.0
+                callbacks = list(self._on_commit)
+            self._notify(callbacks, delta)
+
+    def _notify(self, callbacks, *args):
+        for callback in callbacks:
+            try:
+                callback(*args)
+            except Exception:
+                print_exc()
+
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+def mkb_dispatcher(name, on_commit=None, on_error=None):
+    """ process-wide MKBDispatcher for the multiknob 'name', the callbacks (if given) are attached to it """
+    with _dispatchers_lock:
+        if name not in _dispatchers: _dispatchers[name] = MKBDispatcher(name)
+        knob = _dispatchers[name]
+    knob.attach(on_commit, on_error)
+    return knob
+
+async def aset_mkb(name, delta, timeout=5.0):
+    """ asyncio version of set_mkb, i.e. await aset_mkb('l2_phase', 0.5) """
+    return await arpc(MKB_ADDR, _mkb_request(name, delta), timeout)
@@ -4,21 +4,25 @@
 
 import os
 import sys
+import threading
 import numpy as np
-from PyQt5.QtCore import Qt
+from time import monotonic
+from traceback import print_exc
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QRunnable, QThreadPool
 from pydm.widgets.label import PyDMLabel
 
-from epics import caget, caput
-from PyQt5.QtWidgets import QFrame, QHBoxLayout, QVBoxLayout, QPushButton, QGraphicsOpacityEffect
+from epics import get_pv
+from PyQt5.QtWidgets import QFrame, QHBoxLayout, QVBoxLayout, QGridLayout, QPushButton, QLabel, QGraphicsOpacityEffect
 from pydm.widgets.byte import PyDMByteIndicator
 from pydm.widgets.channel import PyDMChannel
 
-from p4p.client.thread import Context
 from p4p.nt import NTURI
 SELF_PATH = os.path.dirname(os.path.abspath(__file__))
 REPO_ROOT = os.path.join(*os.path.split(SELF_PATH)[:-1])
 sys.path.append(REPO_ROOT)
+sys.path.append(SELF_PATH)
 from F2_pytools import slc_klys as slck
+from pva_context import get_context
 
 STYLE_TEXT_GREEN = """
 color: rgb(0,255,0);
@@ -78,13 +82,264 @@ PV_FB_TEMPLATE_SLC = '{}:FBCK:{}:HSTA'
 
 # HSTA bit index for on/off control of SCP transverse feedbacks
 I_XFB_CONTROL = 11
-RTYPE = NTURI([('TYPE','s')])
 WTYPE = NTURI([('VALUE','d'), ('VALUE_TYPE','s')])
 
+# klystron overview cell colors: bad, not operational, accelerating, standby, off beam
+STYLE_KLYS_BAD = "background-color: rgb(220,0,0); color: rgb(255,255,255);"
+STYLE_KLYS_MAINT = "background-color: rgb(0,200,200); color: rgb(0,0,0);"
+STYLE_KLYS_ACCEL = "background-color: rgb(80,220,120); color: rgb(0,0,0);"
+STYLE_KLYS_STANDBY = "background-color: rgb(255,220,0); color: rgb(0,0,0);"
+STYLE_KLYS_OFF = "background-color: rgb(160,160,160); color: rgb(0,0,0);"
+
 # stupid awful gross magic numbers
 HSTA_FBCK_ON = 268601505
 HSTA_FBCK_COMP = 268599457
 
+# shared pool for blocking control-system I/O (rpc, caget/caput) so the GUI thread never waits on it
+IO_POOL = QThreadPool()
+IO_POOL.setMaxThreadCount(8)
+_running_io = set()
+
+
+class _IOSignals(QObject):
+    result = pyqtSignal(object)
+    error = pyqtSignal(object)
+
+
+class _IOTask(QRunnable):
+
+    def __init__(self, fn, args, kw):
+        QRunnable.__init__(self)
+        self.fn, self.args, self.kw = fn, args, kw
+        self.signals = _IOSignals()
+
+    def run(self):
+        try:
+            res = self.fn(*self.args, **self.kw)
+        except Exception as e:
+            self.signals.error.emit(e)
+            return
+        self.signals.result.emit(res)
+
+
+def run_io(fn, *args, on_result=None, on_error=None, **kw):
+    """
+    run fn(*args, **kw) on IO_POOL, 'on_result'/'on_error' are called on the GUI thread
+    with the return value or the raised exception
+    """
+    task = _IOTask(fn, args, kw)
+    if on_result is not None: task.signals.result.connect(on_result)
+    if on_error is not None: task.signals.error.connect(on_error)
+    # keep the signal object alive until its queued result/error has been delivered
+    _running_io.add(task.signals)
+    task.signals.result.connect(lambda *a, s=task.signals: _running_io.discard(s))
+    task.signals.error.connect(lambda *a, s=task.signals: _running_io.discard(s))
+    IO_POOL.start(task)
+    return task.signals
+
+
+class BackgroundIOMixin:
+    """
+    mixin for QFrame widgets that do control-system I/O, the widget is disabled while
+    a request is running & gets a red border + tooltip if it fails, the style from before
+    the failure is restored by the next successful request
+    """
+
+    _style_before_error = None
+
+    def run_io(self, fn, *args, on_result=None, **kw):
+        self.io_busy()
+
+        def done(res):
+            self.io_done()
+            if on_result is not None: on_result(res)
+
+        def failed(e): self.io_failed(f'{fn.__name__} failed', e)
+
+        return run_io(fn, *args, on_result=done, on_error=failed, **kw)
+
+    def set_base_style(self, style):
+        """ set the widget's normal style, while an error is shown it is applied once the error clears """
+        if self._style_before_error is not None: self._style_before_error = style
+        else: self.setStyleSheet(style)
+
+    def io_busy(self):
+        self.setEnabled(False)
+        self.setToolTip('busy ...')
+
+    def io_done(self):
+        self.setEnabled(True)
+        self.setToolTip('')
+        if self._style_before_error is not None:
+            self.setStyleSheet(self._style_before_error)
+            self._style_before_error = None
+
+    def io_failed(self, what, e):
+        self.setEnabled(True)
+        if self._style_before_error is None: self._style_before_error = self.styleSheet()
+        self.setStyleSheet(STYLE_BRD_RED)
+        self.setToolTip(f'error: {e}')
+        print(f'{type(self).__name__}: {what}: {e}')
+
+
+# seconds to wait for the monitor to show a written bit before reporting the write as failed
+BIT_CONFIRM_TIMEOUT = 5.0
+
+
+class _BitFieldSignals(QObject):
+    # each carries the mask of the bits it applies to
+    busy = pyqtSignal(object)
+    confirmed = pyqtSignal(object)
+    error = pyqtSignal(object, object)
+
+
+class BitFieldController:
+    """
+    shared writer for a packed status word (i.e. PV_LONG_FB_CONTROL), bit changes from all
+    widgets are merged into one write based on the monitored value (no read before writing)
+    & changes requested while a write is running go out together in the next one
+
+    'write' is called as write(new_value) on IO_POOL, the default is a CA put to the monitored pv.
+    bits stay in 'unconfirmed' until the monitor shows the requested state, 'signals' reports
+    busy -> confirmed (or error, also if the monitor doesn't confirm within BIT_CONFIRM_TIMEOUT)
+    for each bit back to the widgets on the GUI thread
+    """
+
+    def __init__(self, pvname, write=None):
+        self.pvname = pvname
+        self.value = None
+        self.unconfirmed = {}
+        self._write = write if write is not None else self._ca_put
+        self._set_mask, self._clear_mask = 0, 0
+        self._lock = threading.Condition()
+        self._writing = False
+        self.signals = _BitFieldSignals()
+        self.pv = get_pv(pvname, callback=self._on_value)
+
+    def set_bit(self, bit, on=True):
+        """ queue a change of a single bit """
+        self.signals.busy.emit(1 << bit)
+        with self._lock:
+            if on:
+                self._set_mask |= (1 << bit)
+                self._clear_mask &= ~(1 << bit)
+            else:
+                self._clear_mask |= (1 << bit)
+                self._set_mask &= ~(1 << bit)
+            self.unconfirmed[bit] = (bool(on), None)
+            if self._writing: return
+            self._writing = True
+        run_io(self._flush)
+
+    def _ca_put(self, value): self.pv.put(value, wait=True, timeout=5.0)
+
+    def _on_value(self, value=None, **kw):
+        if value is None: return
+        confirmed = 0
+        with self._lock:
+            self.value = int(abs(value))
+            for bit, (on, _) in list(self.unconfirmed.items()):
+                if ((self.value >> bit) & 1) == on:
+                    del self.unconfirmed[bit]
+                    confirmed |= (1 << bit)
+            self._lock.notify_all()
+        if confirmed: self.signals.confirmed.emit(confirmed)
+
+    def _drop_unconfirmed(self, mask):
+        """ stop waiting for the bits in 'mask', call with the lock held """
+        for bit in list(self.unconfirmed):
+            if (1 << bit) & mask: del self.unconfirmed[bit]
+
+    def _flush(self):
+        """ write queued changes, then wait for the monitor to confirm them (or time out) """
+        while True:
+            with self._lock:
+                expired = self._wait_for_changes()
+                if expired is None:
+                    self._writing = False
+                    return
+                set_mask, clear_mask = self._set_mask, self._clear_mask
+                self._set_mask, self._clear_mask = 0, 0
+                base = self.value
+            if expired:
+                self.signals.error.emit(expired, TimeoutError(f'{self.pvname} did not show the change'))
+                continue
+            mask = set_mask | clear_mask
+            try:
+                # only before the first monitor update
+                if base is None: base = int(abs(self.pv.get(timeout=5.0)))
+                new_value = (base | set_mask) & ~clear_mask
+                self._write(new_value)
+            except Exception as e:
+                print_exc()
+                with self._lock: self._drop_unconfirmed(mask)
+                self.signals.error.emit(mask, e)
+                continue
+            # bits that already had the requested state won't get a monitor update
+            self._on_value(self.pv.value)
+            deadline = monotonic() + BIT_CONFIRM_TIMEOUT
+            with self._lock:
+                # the monitor confirms this later, until then the next batch builds on the written value
+                self.value = new_value
+                for bit, (on, _) in list(self.unconfirmed.items()):
+                    if (1 << bit) & mask: self.unconfirmed[bit] = (on, deadline)
+
+    def _wait_for_changes(self):
+        """
+        call with the lock held, waits until there are queued changes (returns 0), written bits
+        were not confirmed in time (returns their mask) or nothing is left to confirm (returns None)
+        """
+        while not (self._set_mask or self._clear_mask):
+            now = monotonic()
+            deadlines = {bit: d for bit, (_, d) in self.unconfirmed.items() if d is not None}
+            expired = sum(1 << bit for bit, d in deadlines.items() if d <= now)
+            if expired:
+                self._drop_unconfirmed(expired)
+                return expired
+            if not deadlines: return None
+            self._lock.wait(min(deadlines.values()) - now)
+        return 0
+
+_bit_fields = {}
+_bit_fields_lock = threading.Lock()
+
+def bit_field(pvname, write=None):
+    """ process-wide BitFieldController for 'pvname', 'write' only applies when it is first created """
+    with _bit_fields_lock:
+        if pvname not in _bit_fields: _bit_fields[pvname] = BitFieldController(pvname, write)
+        return _bit_fields[pvname]
+
+class BitFieldWidgetMixin(BackgroundIOMixin):
+    """
+    BackgroundIOMixin for widgets that write a single bit through a BitFieldController, the widget
+    is busy until the monitor confirms its bit & shows the error if the write fails or isn't confirmed
+    """
+
+    def watch_bit_field(self, controller, bit):
+        self._watched_mask = 1 << bit
+        controller.signals.busy.connect(self._bit_field_busy)
+        controller.signals.confirmed.connect(self._bit_field_confirmed)
+        controller.signals.error.connect(self._bit_field_failed)
+
+    def _bit_field_busy(self, mask):
+        if mask & self._watched_mask: self.io_busy()
+
+    def _bit_field_confirmed(self, mask):
+        if mask & self._watched_mask: self.io_done()
+
+    def _bit_field_failed(self, mask, e):
+        if mask & self._watched_mask: self.io_failed(f'writing bit {self._watched_mask.bit_length() - 1} failed', e)
+
+def _hsta_writer(channel):
+    """ write function for SCP feedback HSTA words, these are written through AIDA-PVA """
+    def write(value):
+        writecall = WTYPE.wrap(
+            scheme='pva', path=channel,
+            kws={'VALUE':int(value), 'VALUE_TYPE':'INTEGER_ARRAY'}
+            )
+        get_context('pva').rpc(channel, writecall, timeout=5.0)
+    return write
+
 
 class SCPSteeringIndicator(PyDMLabel):
     """ checks FBCK hardware status to check for feedback enable/compute """
@@ -106,7 +361,7 @@ class SCPSteeringIndicator(PyDMLabel):
         else:                            
             self.setText('Off/Sample')
 
-class SCPSteeringToggleButton(QFrame):
+class SCPSteeringToggleButton(BitFieldWidgetMixin, QFrame):
     """
     subclass to make a toggle button for F2 feedback controls
     needs to set single bits of an overall status word
@@ -121,7 +376,8 @@ class SCPSteeringToggleButton(QFrame):
         self.channel = PV_FB_TEMPLATE.format(micro, unit)
 
         # AIDA-PVA for writing, CA monitor for watching on/off state
-        self.ctx = Context('pva')
+        self.hsta = bit_field(PV_FB_TEMPLATE_SLC.format(micro, unit), write=_hsta_writer(self.channel))
+        self.watch_bit_field(self.hsta, I_XFB_CONTROL)
         self.FB_state = PyDMChannel(address=PV_FB_TEMPLATE_SLC.format(micro, unit),
             value_slot=self.set_enable_states)
         self.FB_state.connect()
@@ -138,31 +394,9 @@ class SCPSteeringToggleButton(QFrame):
         L.setContentsMargins(0,0,0,0)
         self.setLayout(L)
 
-    def get_fb_stat(self):
-        readcall = RTYPE.wrap(
-            scheme='pva', path=self.channel, kws={'TYPE':'INTEGER'}
-            )
-        res = self.ctx.rpc(self.channel, readcall, timeout=5.0)
-        return res.raw.value
-
-    def set_fb_stat(self, enable=True):
-        init_state = self.get_fb_stat()
-
-        if enable:
-            new_state = init_state | (1 << I_XFB_CONTROL)
-        else:
-            new_state = init_state & ~(1 << I_XFB_CONTROL)
-
-        writecall = WTYPE.wrap(
-            scheme='pva', path=self.channel,
-            kws={'VALUE':int(new_state), 'VALUE_TYPE':'INTEGER_ARRAY'}
-            )
-        res = self.ctx.rpc(self.channel, writecall, timeout=5.0)
-        return res.raw.value
-
-    def enable_fb(self): self.set_fb_stat(enable=True)
+    def enable_fb(self): self.hsta.set_bit(I_XFB_CONTROL, True)
 
-    def disable_fb(self): self.set_fb_stat(enable=False)
+    def disable_fb(self): self.hsta.set_bit(I_XFB_CONTROL, False)
 
     def set_enable_states(self, new_value):
         feedback_on = (new_value == HSTA_FBCK_ON)
@@ -171,7 +405,7 @@ class SCPSteeringToggleButton(QFrame):
         off_style = STYLE_TEXT_RED if not feedback_on else STYLE_TEXT_WHITE
 
         border = STYLE_BRD_GREEN if feedback_on else STYLE_BRD_RED
-        self.setStyleSheet(border)
+        self.set_base_style(border)
 
         self.toggle_on.setDown(feedback_on)
         self.toggle_on.setEnabled(not feedback_on)
@@ -182,7 +416,7 @@ class SCPSteeringToggleButton(QFrame):
         self.toggle_off.setStyleSheet(off_style)
 
 
-class F2LongFBToggleButton(QFrame):
+class F2LongFBToggleButton(BitFieldWidgetMixin, QFrame):
     """
     subclass to make a toggle button for F2 feedback controls
     needs to set single bits of an overall status word
@@ -191,6 +425,8 @@ class F2LongFBToggleButton(QFrame):
     def __init__(self, bit_ID, parent=None, args=None):
         QFrame.__init__(self, parent=parent)
         self.bit = bit_ID
+        self.control = bit_field(PV_LONG_FB_CONTROL)
+        self.watch_bit_field(self.control, self.bit)
         self.toggle_on = QPushButton('ON')
         self.toggle_off = QPushButton('OFF')
 
@@ -213,15 +449,9 @@ class F2LongFBToggleButton(QFrame):
         L.setContentsMargins(0,0,0,0)
         self.setLayout(L)
 
-    def enable_fb(self):
-        init_ctrl_state = int(caget(PV_LONG_FB_CONTROL))
-        new_ctrl_state = init_ctrl_state | (1 << self.bit)
-        caput(PV_LONG_FB_CONTROL, new_ctrl_state)
+    def enable_fb(self): self.control.set_bit(self.bit, True)
 
-    def disable_fb(self):
-        init_ctrl_state = int(caget(PV_LONG_FB_CONTROL))
-        new_ctrl_state = init_ctrl_state & ~(1 << self.bit)
-        caput(PV_LONG_FB_CONTROL, new_ctrl_state)
+    def disable_fb(self): self.control.set_bit(self.bit, False)
 
     def set_button_enable_states(self, new_value):
         feedback_on = (int(abs(new_value)) >> (self.bit)) & 1
@@ -230,7 +460,7 @@ class F2LongFBToggleButton(QFrame):
         off_style = STYLE_TEXT_RED if not feedback_on else STYLE_TEXT_WHITE
 
         border = STYLE_BRD_GREEN if feedback_on else STYLE_BRD_RED
-        self.setStyleSheet(border)
+        self.set_base_style(border)
 
         self.toggle_on.setDown(feedback_on)
         self.toggle_on.setEnabled(not feedback_on)
@@ -241,9 +471,15 @@ class F2LongFBToggleButton(QFrame):
         self.toggle_off.setStyleSheet(off_style)
 
 
-class F2KlysToggleButton(QFrame):
+class F2KlysToggleButton(BackgroundIOMixin, QFrame):
+    """
+    react/deact buttons for a single klystron, with 'track_status' the button state follows
+    the shared slc_klys.status_service() instead of each widget polling on its own
+    """
+
+    status_changed = pyqtSignal(dict)
 
-    def __init__(self, klys_name, parent=None, args=None):
+    def __init__(self, klys_name, parent=None, args=None, track_status=False):
         QFrame.__init__(self, parent=parent)
         self.toggle_on = QPushButton('REACT')
         self.toggle_off = QPushButton('DEACT')
@@ -260,21 +496,30 @@ class F2KlysToggleButton(QFrame):
         L.setSpacing(1)
         L.setContentsMargins(0,0,0,0)
         self.setLayout(L)
+
+        # status rows arrive on the polling thread, the signal moves them to the GUI thread
+        self._status_token = None
+        if track_status:
+            self.status_changed.connect(self.update_status)
+            self._status_token = slck.status_service().subscribe(self.status_changed.emit, klys=[self.kname])
+            self.destroyed.connect(lambda *a, token=self._status_token: slck.status_service().unsubscribe(token))
         return
 
+    def update_status(self, changed):
+        row = changed.get(self.kname)
+        if row is not None: self.set_button_enable_states(onbeam=bool(row['accel']))
+
     def react(self):
-        slck.react(self.kname)
-        self.set_button_enable_states(onbeam=True)
+        self.run_io(slck.react, self.kname, on_result=lambda res: self.set_button_enable_states(onbeam=True))
         return
 
     def deact(self):
-        slck.deact(self.kname)
-        self.set_button_enable_states(onbeam=False)
+        self.run_io(slck.deact, self.kname, on_result=lambda res: self.set_button_enable_states(onbeam=False))
         return
 
     def set_button_enable_states(self, onbeam=True, maint=False):
         if maint:
-            self.setStyleSheet(STYLE_BRD_CYAN)
+            self.set_base_style(STYLE_BRD_CYAN)
             self.setEnabled(False)
             self.setGraphicsEffect(QGraphicsOpacityEffect(opacity=0.5))
             return
@@ -282,7 +527,7 @@ class F2KlysToggleButton(QFrame):
             self.setEnabled(True)
 
         border = STYLE_BRD_GREEN if onbeam else STYLE_BRD_YELLOW
-        self.setStyleSheet(border)
+        self.set_base_style(border)
 
         self.toggle_on.setDown(onbeam)
         self.toggle_on.setEnabled(not onbeam)
@@ -290,3 +535,54 @@ class F2KlysToggleButton(QFrame):
         self.toggle_off.setDown(not onbeam)
         self.toggle_off.setEnabled(onbeam)
 
+
+class F2KlysOverview(QFrame):
+    """
+    sector x station grid of every klystron in slc_klys.F2_ALL_KLYS, fed by the shared
+    slc_klys.status_service() so the whole panel costs one KLYSTRONGET:TACT rpc per period
+    & only cells whose status row changed are repainted
+    """
+
+    status_changed = pyqtSignal(dict)
+
+    def __init__(self, parent=None, args=None, period=1.0):
+        QFrame.__init__(self, parent=parent)
+        self.cells = {}
+
+        L = QGridLayout()
+        for name in slck.F2_ALL_KLYS:
+            sector, station = name.split(':')[1:]
+            row, col = int(sector[2:]) - 10, int(station[0])
+            if col == 1: L.addWidget(QLabel(sector), row, 0)
+            if row == 1: L.addWidget(QLabel(station[0]), 0, col, alignment=Qt.AlignCenter)
+            cell = QLabel(station)
+            cell.setAlignment(Qt.AlignCenter)
+            cell.setMinimumWidth(30)
+            cell.setStyleSheet(STYLE_KLYS_OFF)
+            self.cells[name] = cell
+            L.addWidget(cell, row, col)
+        L.setSpacing(2)
+        L.setContentsMargins(0,0,0,0)
+        self.setLayout(L)
+
+        # status rows arrive on the polling thread, the signal moves them to the GUI thread
+        self.status_changed.connect(self.update_cells)
+        token = slck.status_service(period).subscribe(self.status_changed.emit, klys=slck.F2_ALL_KLYS)
+        self.destroyed.connect(lambda *a: slck.status_service().unsubscribe(token))
+
+    def update_cells(self, changed):
+        for name, row in changed.items():
+            cell = self.cells.get(name)
+            if cell is None: continue
+            cell.setStyleSheet(self.cell_style(row))
+            cell.setText(name.split(':')[2] + ('*' if row['sled'] else ''))
+            flags = ('opstat', 'accel', 'standby', 'bad', 'sled', 'sleded')
+            cell.setToolTip(f'{name}\n' + '\n'.join(f'{f}: {bool(row[f])}' for f in flags))
+
+    @staticmethod
+    def cell_style(row):
+        if row['bad']: return STYLE_KLYS_BAD
+        if not row['opstat']: return STYLE_KLYS_MAINT
+        if row['accel']: return STYLE_KLYS_ACCEL
+        if row['standby']: return STYLE_KLYS_STANDBY
+        return STYLE_KLYS_OFF